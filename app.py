@@ -1,264 +1,565 @@
 from flask import Flask, render_template, Response, jsonify, g, request,redirect,url_for,flash
-import cv2
 import numpy as np
-from attendance_system import load_known_faces, mark_attendance
-from database import FaceDatabase
+from bulk_import import bulk_import, collect_directory, collect_zip
+from enrollment import check_enrollment_face
+from gallery import GalleryCache
+from matcher import build_matcher, matcher_is_stale
+from metrics import REGISTRY, START_TIME, SamplingProfiler, histogram
+from pipeline import PipelineManager, RecognitionPipeline
+from detection import FaceDetector
+from tracker import FaceTracker
+from workers import LocalFrame, RecognitionWorkerPool
+import csv
+import io
+import json
+import os
 import threading
-import face_recognition
 import logging
 from datetime import datetime, timedelta
-from functools import lru_cache
 import time
 from logging.handlers import RotatingFileHandler
 import sqlite3
+import zipfile
 
 
 # Initialize Flask app
 app = Flask(__name__)
 app.config.update({
-    'VIDEO_SOURCE': 0,
+    # Named video sources: device index, video file or stream URL, or a dict
+    # {'source': ..., 'loop': bool, 'realtime': bool, 'roi': (top, right,
+    # bottom, left)}. Files default to looping in real time so they can
+    # stand in for an RTSP camera. 'roi' limits detection to that part of
+    # the frame, given as fractions of its height and width.
+    'CAMERAS': {
+        'main': 0,
+    },
+    'DEFAULT_CAMERA': 'main',
+    'RECOGNITION_WORKERS': None,  # Worker processes (None = all cores, 0 = in-process)
+    'BULK_IMPORT_WORKERS': None,  # Worker processes for /register/bulk (None = all cores)
+    'BULK_IMPORT_ROOT': None,  # Server directory /register/bulk may import from (None = uploads only)
     'FACE_RECOGNITION_THRESHOLD': 0.6,
-    'CACHE_TIMEOUT_MINUTES': 5,
     'FRAME_SKIP_RATE': 2 , # Process every 2nd frame
+    'DETECTION_MODEL': 'hog',  # 'hog' (CPU) or 'cnn' (needs dlib with CUDA)
+    'DETECTION_UPSAMPLE': 1,  # Upsampling passes; each finds smaller faces at ~4x the cost
+    'DETECTION_SCALE': 0.25,  # Resize factor for detection and encoding...
+    'DETECTION_TARGET_FPS': None,  # ...adapted to hold this recognition rate (None = fixed)
+    'DETECTION_MIN_SCALE': 0.1,
+    'DETECTION_MAX_SCALE': 1.0,
+    'DETECTION_TRACK_REGIONS': False,  # Scan only around last frame's faces...
+    'DETECTION_FULL_SCAN_INTERVAL': 10,  # ...plus a full scan every N recognized frames
+    'RECOGNITION_QUEUE_SIZE': 2,  # Frames waiting for recognition before dropping
+    'FACE_TRACKING': True,  # Only encode new faces...
+    'TRACK_REVERIFY_INTERVAL': 15,  # ...and re-verify tracked ones every N processed frames
+    'RECOGNITION_HISTORY_SIZE': 30,  # Recent recognition results kept per camera
+    'RESULT_MAX_AGE_SECONDS': 2,  # /mark_attendance ignores older results
+    'AUTO_MARK': False,  # Record attendance without a click...
+    'AUTO_MARK_MIN_FRAMES': 3,  # ...once matched in K
+    'AUTO_MARK_WINDOW': 5,  # ...of the last M recognized frames
+    'ANN_MIN_GALLERY_SIZE': 10000,  # Exact search below this many encodings
+    'ANN_INDEX_PATH': 'face_index.npz',
+    'GALLERY_SNAPSHOT_PATH': 'gallery.snapshot',  # Memory-mapped gallery shared by all workers
+    'GALLERY_TEMPLATES': True,  # Match each user's centroid (one row per person), not every encoding
+    'ENROLL_MIN_FACE_SIZE': 80,  # Reject enrollment photos whose face is smaller (pixels)...
+    'ENROLL_MIN_SHARPNESS': 50.0,  # ...or blurrier (variance of the Laplacian)
+    'PAGE_SIZE': 50,  # Rows per page on /users and /attendance
+    'PROFILER_ENABLED': False,  # Allow starting the sampling profiler via /debug/profiler
+    'ASYNC_EXECUTOR_WORKERS': 32,  # Threads for blocking work under the asyncio server (asgi.py)
     'SECRET_KEY': 'your_secret_key_here'
 })
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[
-        logging.FileHandler('app.log'),
-        logging.StreamHandler()
-    ]
-)
+def configure_logging():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s [%(levelname)s] %(message)s',
+        handlers=[
+            logging.FileHandler('app.log'),
+            logging.StreamHandler()
+        ]
+    )
 
 # Global variables with thread safety
-current_frame = None
 processing_lock = threading.Lock()
-last_cache_clear = datetime.now()
 
-# Database connection management
+class Lazy:
+    """
+    A value built by `factory` on first get(), once, even when several
+    threads ask at the same time. set() replaces it (benchmarks, tests).
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self._value = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def get(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._value = self.factory()
+                    self._loaded = True
+        return self._value
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+            self._loaded = True
+
+# Importing attendance_system opens the database pool and starts the
+# attendance writer, so it happens on first use (or during warm-up)
+# rather than when this module is imported
+def _import_attendance_system():
+    import attendance_system
+    return attendance_system
+
+attendance = Lazy(_import_attendance_system)
+
+def mark_attendance(user_id, name, **options):
+    return attendance.get().mark_attendance(user_id, name, **options)
+
+# Database connection management: requests borrow the calling thread's
+# long-lived pooled connection instead of opening one each time
 def get_db():
     if 'db' not in g:
-        g.db = FaceDatabase()
-        try:
-            g.db._create_tables()
-        except Exception as e:
-            app.logger.error(f"Table creation failed: {str(e)}")
+        g.db = attendance.get().db.get()
     return g.db
 
 @app.teardown_appcontext
 def close_db(e=None):
     db = g.pop('db', None)
-    if db is not None:
-        db.close()
-
-# Face caching with automatic refresh
-@lru_cache(maxsize=1)
-def get_cached_known_faces():
-    logging.info("Loading known faces from database")
-    return load_known_faces()
-
-def clear_face_cache():
-    global last_cache_clear
-    now = datetime.now()
-    if now - last_cache_clear > timedelta(minutes=app.config['CACHE_TIMEOUT_MINUTES']):
-        get_cached_known_faces.cache_clear()
-        last_cache_clear = now
-        logging.info("Cleared face recognition cache")
+    if db is not None and db.conn.in_transaction:
+        db.conn.rollback()
 
-# Video feed generator
-def generate_frames():
-    # Initialize camera with error handling
-    global current_frame
-    try:
-        cap = cv2.VideoCapture(0)
-        if not cap.isOpened():
-            raise RuntimeError("Could not open camera")
-    except Exception as e:
-        logging.error(f"Camera initialization failed: {str(e)}")
-        return
-    
-    frame_counter = 0
+# Face gallery kept in sync with the database by applying deltas
+def create_gallery_cache():
+    snapshot_path = app.config['GALLERY_SNAPSHOT_PATH']
+    if snapshot_path and app.config['GALLERY_TEMPLATES']:
+        # Versioned by a different change log, so never the same file
+        snapshot_path += '.templates'
+    return GalleryCache(
+        attendance.get().db,
+        matcher_factory=lambda gallery: build_matcher(
+            gallery,
+            min_ann_size=app.config['ANN_MIN_GALLERY_SIZE'],
+            index_path=app.config['ANN_INDEX_PATH']
+        ),
+        snapshot_path=snapshot_path,
+        templates=app.config['GALLERY_TEMPLATES'],
+        matcher_is_stale=lambda matcher: matcher_is_stale(
+            matcher, min_ann_size=app.config['ANN_MIN_GALLERY_SIZE'])
+    )
+
+gallery_cache = Lazy(create_gallery_cache)
+
+def get_cached_matcher():
+    # Cheap version check; only new or removed encodings are loaded
+    return gallery_cache.get().refresh()
+
+def max_match_distance():
+    # A match needs confidence (1 - distance) above the threshold
+    return 1 - app.config['FACE_RECOGNITION_THRESHOLD']
+
+# Detection and encoding run in worker processes, outside the Flask process's GIL
+def create_recognition_pool():
+    if app.config['RECOGNITION_WORKERS'] == 0:
+        return None
+    return RecognitionWorkerPool(app.config['RECOGNITION_WORKERS'])
+
+recognition_pool = Lazy(create_recognition_pool)
+
+def shared_frame(frame):
+    """Handle for running detection and encoding on a frame in the worker pool."""
+    pool = recognition_pool.get()
+    if pool is not None:
+        return pool.frame(frame)
+    return LocalFrame(frame)
+
+def create_detector(roi=None):
+    return FaceDetector(
+        model=app.config['DETECTION_MODEL'],
+        upsample=app.config['DETECTION_UPSAMPLE'],
+        scale=app.config['DETECTION_SCALE'],
+        min_scale=app.config['DETECTION_MIN_SCALE'],
+        max_scale=app.config['DETECTION_MAX_SCALE'],
+        target_fps=app.config['DETECTION_TARGET_FPS'],
+        roi=roi,
+        track_regions=app.config['DETECTION_TRACK_REGIONS'],
+        full_scan_interval=app.config['DETECTION_FULL_SCAN_INTERVAL']
+    )
+
+RECOGNITION_STAGE_SECONDS = histogram(
+    'recognition_stage_seconds', "Time per recognized frame in each recognition step", ['stage'])
+
+# Recognition stage: runs on a worker thread at whatever rate the CPU allows
+def recognize_frame(frame, tracker=None, detector=None, timings=None):
+    """
+    Detect and identify faces. Returns one dict per face with its box
+    (full-frame coordinates), encoding and best match; user_id and name
+    are None when nobody matched confidently. With a tracker, faces that
+    were already identified in earlier frames skip the encoder. The
+    detector decides the scale and regions to scan and is told how long
+    the frame took. If `timings` is a dict, the seconds spent in the
+    detect, encode and match stages are stored in it.
+    """
+    start = time.perf_counter()
+    if detector is None:
+        detector = create_detector()
+    scale, regions = detector.plan(frame.shape)
+    with shared_frame(frame) as shared:
+        face_locations = shared.locate(
+            scale, model=detector.model, upsample=detector.upsample, regions=regions)
+        detected = time.perf_counter()
+        if tracker is not None:
+            tracks, needs_encoding = tracker.update(face_locations)
+        else:
+            tracks, needs_encoding = [None] * len(face_locations), list(range(len(face_locations)))
+        face_encodings = shared.encode([face_locations[i] for i in needs_encoding], scale)
+    encoded = time.perf_counter()
     
-    try:
-        while True:
-            success, frame = cap.read()
-            frame_counter += 1
-            
-            if not success:
-                logging.warning("Frame capture failed")
-                break
-                
-            # Skip frames for performance
-            if frame_counter % app.config['FRAME_SKIP_RATE'] != 0:
-                continue
-                
-            # Process frame
-            small_frame = cv2.resize(frame, (0, 0), fx=0.25, fy=0.25)
-            rgb_small_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
-            
-            # Face detection
-            face_locations = face_recognition.face_locations(rgb_small_frame)
-            face_encodings = face_recognition.face_encodings(rgb_small_frame, face_locations)
+    identities = {}
+    with processing_lock:
+        matcher = get_cached_matcher()
+        
+        # Match every newly encoded face with a single search call
+        best_indices, best_distances = matcher.search(
+            face_encodings, k=1, threshold=max_match_distance())
+        
+        for i, encoding, best_match_index, distance in zip(
+                needs_encoding, face_encodings, best_indices[:, 0], best_distances[:, 0]):
+            confidence = 1 - distance
+            user_id = name = None
             
-            with processing_lock:
-                current_frame = frame.copy()
-                known_encodings, known_names, user_ids = get_cached_known_faces()
+            if best_match_index >= 0 and confidence > app.config['FACE_RECOGNITION_THRESHOLD']:
+                user_id, name = matcher.gallery.identity(best_match_index)
                 
-                for (top, right, bottom, left), face_encoding in zip(face_locations, face_encodings):
-                    # Face recognition
-                    face_distances = face_recognition.face_distance(known_encodings, face_encoding)
-                    best_match_index = np.argmin(face_distances)
-                    confidence = 1 - face_distances[best_match_index]
-                    
-                    if confidence > app.config['FACE_RECOGNITION_THRESHOLD']:
-                        name = known_names[best_match_index]
-                        user_id = user_ids[best_match_index]
-                        
-                        # Scale coordinates back to original size
-                        top *= 4; right *= 4; bottom *= 4; left *= 4
-                        
-                        # Draw bounding box and label
-                        cv2.rectangle(frame, (left, top), (right, bottom), (0, 255, 0), 2)
-                        cv2.putText(
-                            frame, 
-                            f"{name} ({confidence:.2f})", 
-                            (left + 6, bottom - 6), 
-                            cv2.FONT_HERSHEY_SIMPLEX, 
-                            0.5, 
-                            (255, 255, 255), 
-                            1
-                        )
-            
-            # Yield frame
-            ret, buffer = cv2.imencode('.jpg', frame)
-            frame_bytes = buffer.tobytes()
+            identities[i] = (encoding, user_id, name, float(distance), float(confidence))
+    
+    faces = []
+    for i, location in enumerate(face_locations):
+        track = tracks[i]
+        if i in identities:
+            encoding, user_id, name, distance, confidence = identities[i]
+            if track is not None:
+                track.identify(encoding, user_id, name, distance, confidence)
+        else:
+            # Stable face: reuse the identity from the track's last encoding
+            encoding, user_id, name = track.encoding, track.user_id, track.name
+            distance, confidence = track.distance, track.confidence
+        faces.append({
+            'box': location,
+            'track_id': track.track_id if track is not None else None,
+            'encoding': encoding,
+            'user_id': user_id,
+            'name': name,
+            'distance': distance,
+            'confidence': confidence
+        })
+    finished = time.perf_counter()
+    detector.observe(face_locations, finished - start)
+    stage_timings = {'detect': detected - start, 'encode': encoded - detected, 'match': finished - encoded}
+    for stage, seconds in stage_timings.items():
+        RECOGNITION_STAGE_SECONDS.labels(stage=stage).observe(seconds)
+    if timings is not None:
+        timings.update(stage_timings)
+    return faces
+
+def draw_detections(frame, faces):
+    """Draw bounding boxes and labels for the most recent recognition results."""
+    import cv2
+
+    for face in faces:
+        if face['user_id'] is None:
+            continue
+        top, right, bottom, left = face['box']
+        cv2.rectangle(frame, (left, top), (right, bottom), (0, 255, 0), 2)
+        cv2.putText(
+            frame, 
+            f"{face['name']} ({face['confidence']:.2f})", 
+            (left + 6, bottom - 6), 
+            cv2.FONT_HERSHEY_SIMPLEX, 
+            0.5, 
+            (255, 255, 255), 
+            1
+        )
+
+def auto_mark_attendance(pipeline, result):
+    """Mark anyone confidently matched in K of the last M recognized frames."""
+    if not app.config['AUTO_MARK']:
+        return
+    confirmed = pipeline.history.consensus(
+        app.config['AUTO_MARK_MIN_FRAMES'], app.config['AUTO_MARK_WINDOW'])
+    for user_id, (name, distance) in confirmed.items():
+        # Cheap for people already present: mark_attendance caches them per day
+        if mark_attendance(user_id, name):
+            logging.info(f"Auto-marked attendance for {name} ({1 - distance:.2f})")
+
+def camera_options(camera):
+    """Normalize a CAMERAS entry to RecognitionPipeline keyword arguments (plus 'roi')."""
+    spec = app.config['CAMERAS'][camera]
+    options = dict(spec) if isinstance(spec, dict) else {'source': spec}
+    is_file = isinstance(options['source'], str) and os.path.isfile(options['source'])
+    options.setdefault('loop', is_file)
+    options.setdefault('realtime', is_file)
+    return options
+
+def create_pipeline(camera):
+    options = camera_options(camera)
+    tracker = None
+    if app.config['FACE_TRACKING']:
+        tracker = FaceTracker(reverify_interval=app.config['TRACK_REVERIFY_INTERVAL'])
+    return RecognitionPipeline(
+        recognize=recognize_frame,
+        draw=draw_detections,
+        frame_skip_rate=app.config['FRAME_SKIP_RATE'],
+        recognition_queue_size=app.config['RECOGNITION_QUEUE_SIZE'],
+        history_size=app.config['RECOGNITION_HISTORY_SIZE'],
+        on_result=auto_mark_attendance,
+        tracker=tracker,
+        detector=create_detector(options.pop('roi', None)),
+        name=camera,
+        **options
+    )
+
+# One shared capture + recognition producer per camera, fanned out to clients
+pipelines = PipelineManager(create_pipeline)
+
+# Video feed generator
+def generate_frames(camera):
+    frames = pipelines.subscribe(camera)
+    try:
+        for frame_bytes in frames:
             yield (b'--frame\r\n'
                    b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-    
+    except Exception as e:
+        logging.error(f"Camera initialization failed: {str(e)}")
     finally:
-        cap.release()
-        logging.info("Camera resource released")
+        frames.close()
+
+# Startup warm-up: everything the first recognized frame would otherwise
+# wait for, loaded in the background so pages are served meanwhile
+readiness = {'database': 'pending', 'gallery': 'pending', 'recognition': 'pending'}
+warm_up_thread = None
+
+def warm_up_recognition():
+    import cv2  # Drawing and JPEG encoding
+
+    pool = recognition_pool.get()
+    if pool is not None:
+        pool.warm_up()
+    else:
+        # The first detection loads the face models in this process
+        LocalFrame(np.zeros((120, 160, 3), dtype=np.uint8)).locate()
+
+def warm_up():
+    steps = [
+        ('database', attendance.get),
+        ('gallery', get_cached_matcher),
+        ('recognition', warm_up_recognition),
+    ]
+    for component, step in steps:
+        start = time.perf_counter()
+        try:
+            step()
+            readiness[component] = 'ready'
+            logging.info(f"Warm-up: {component} ready in {time.perf_counter() - start:.2f}s")
+        except Exception as e:
+            readiness[component] = f"failed: {str(e)}"
+            logging.error(f"Warm-up: {component} failed: {str(e)}")
+
+def is_ready():
+    return all(state == 'ready' for state in readiness.values())
+
+def create_app(config=None, warm=True):
+    """
+    Configure the app and start warming it up in the background. Returns
+    at once: pages that only need the database are served straight away
+    while /health reports readiness. Serve with e.g.
+    gunicorn 'app:create_app()'.
+    """
+    global warm_up_thread
+    app.config.update(config or {})
+    configure_logging()
+    if warm and warm_up_thread is None:
+        warm_up_thread = threading.Thread(target=warm_up, name='warm-up', daemon=True)
+        warm_up_thread.start()
+    return app
 
 # Flask routes
 @app.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/video_feed')
-def video_feed():
-    clear_face_cache()  # Periodic cache maintenance
+@app.route('/video_feed', defaults={'camera': None})
+@app.route('/video_feed/<camera>')
+def video_feed(camera):
+    camera = camera or app.config['DEFAULT_CAMERA']
+    if camera not in app.config['CAMERAS']:
+        return f"Unknown camera: {camera}", 404
     return Response(
-        generate_frames(),
+        generate_frames(camera),
         mimetype='multipart/x-mixed-replace; boundary=frame'
     )
-@app.route('/mark_attendance')
-def mark_attendance_endpoint():
+def attendance_for_camera(camera):
+    """
+    Mark attendance for the best confident match in the camera's latest
+    recognition result. Returns (payload, HTTP status); shared by the
+    Flask route and the asyncio server (asgi.py).
+    """
+    if camera not in app.config['CAMERAS']:
+        return {
+            "status": "error",
+            "message": f"Unknown camera: {camera}"
+        }, 404
     try:
-        clear_face_cache()
-        
-        with processing_lock:
-            # Check camera frame
-            if current_frame is None:
-                app.logger.error("No frame available for attendance marking")
-                return jsonify({
-                    "status": "error", 
-                    "message": "Camera feed not available"
-                }), 400
-                
-            # Process frame
-            small_frame = cv2.resize(current_frame, (0, 0), fx=0.25, fy=0.25)
-            rgb_small_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
-            face_encodings = face_recognition.face_encodings(rgb_small_frame)
+        # Reuse the stream's latest recognition result instead of re-encoding
+        pipeline = pipelines.get(camera)
+        latest = None
+        if pipeline is not None:
+            latest = pipeline.history.latest(max_age=app.config['RESULT_MAX_AGE_SECONDS'])
+        if latest is None:
+            app.logger.error("No recent recognition result for attendance marking")
+            return {
+                "status": "error", 
+                "message": "Camera feed not available"
+            }, 400
             
-            if not face_encodings:
-                app.logger.warning("No faces detected in frame")
-                return jsonify({
-                    "status": "error", 
-                    "message": "No face detected - please face the camera"
-                }), 400
-                
+        if not latest['faces']:
+            app.logger.warning("No faces detected in frame")
+            return {
+                "status": "error", 
+                "message": "No face detected - please face the camera"
+            }, 400
+            
+        with processing_lock:
             # Get known faces with validation
-            known_encodings, known_names, user_ids = get_cached_known_faces()
-            if not known_encodings:
+            matcher = get_cached_matcher()
+            if len(matcher.gallery) == 0:
                 app.logger.error("No registered faces in database")
-                return jsonify({
+                return {
                     "status": "error",
                     "message": "System has no registered users"
-                }), 400
-                
-            # Calculate face distances
-            face_distances = face_recognition.face_distance(known_encodings, face_encodings[0])
-            if len(face_distances) == 0:
-                app.logger.error("Face distance calculation failed")
-                return jsonify({
-                    "status": "error",
-                    "message": "Recognition system error"
-                }), 500
+                }, 400
                 
-            best_match_index = np.argmin(face_distances)
-            confidence = 1 - face_distances[best_match_index]
+        # Most confident face in the frame
+        matched = [face for face in latest['faces'] if face['user_id'] is not None]
+        if matched:
+            best = min(matched, key=lambda face: face['distance'])
+            user_id, name, confidence = best['user_id'], best['name'], best['confidence']
             
-            if confidence > app.config['FACE_RECOGNITION_THRESHOLD']:
-                name = known_names[best_match_index]
-                user_id = user_ids[best_match_index]
+            try:
+                # Wait for the commit so the response reflects what was stored
+                success = mark_attendance(user_id, name, wait=True)
+                current_time = datetime.now().strftime("%H:%M:%S")
                 
-                try:
-                    db = get_db()
-                    success = mark_attendance(user_id, name)
-                    current_time = datetime.now().strftime("%H:%M:%S")
+                if success:
+                    app.logger.info(f"Attendance marked for {name}")
+                    return {
+                        "status": "success",
+                        "name": name,
+                        "time": current_time,
+                        "confidence": round(confidence, 2)
+                    }, 200
+                else:
+                    app.logger.info(f"Duplicate attendance for {name}")
+                    return {
+                        "status": "info",
+                        "message": f"{name} already marked today",
+                        "time": current_time
+                    }, 200
                     
-                    if success:
-                        app.logger.info(f"Attendance marked for {name}")
-                        return jsonify({
-                            "status": "success",
-                            "name": name,
-                            "time": current_time,
-                            "confidence": round(confidence, 2)
-                        })
-                    else:
-                        app.logger.info(f"Duplicate attendance for {name}")
-                        return jsonify({
-                            "status": "info",
-                            "message": f"{name} already marked today",
-                            "time": current_time
-                        })
-                        
-                except Exception as e:
-                    app.logger.error(f"Database error: {str(e)}")
-                    return jsonify({
-                        "status": "error",
-                        "message": "Database operation failed"
-                    }), 500
-                    
-            return jsonify({
-                "status": "error", 
-                "message": "Recognition confidence too low"
-            }), 400
+            except Exception as e:
+                app.logger.error(f"Database error: {str(e)}")
+                return {
+                    "status": "error",
+                    "message": "Database operation failed"
+                }, 500
+                
+        return {
+            "status": "error", 
+            "message": "Recognition confidence too low"
+        }, 400
             
     except Exception as e:
         app.logger.error(f"Unexpected error: {str(e)}")
-        return jsonify({
+        return {
             "status": "error",
             "message": "Internal server error"
-        }), 500
+        }, 500
+
+@app.route('/mark_attendance', defaults={'camera': None})
+@app.route('/mark_attendance/<camera>')
+def mark_attendance_endpoint(camera):
+    camera = camera or app.config['DEFAULT_CAMERA']
+    payload, status = attendance_for_camera(camera)
+    return jsonify(payload), status
+
+# Pipeline statistics endpoint
+@app.route('/pipeline_stats')
+def pipeline_stats():
+    return jsonify(pipelines.stats())
 
 # Health check endpoint
+def health_status():
+    return {
+        "status": "healthy",
+        "timestamp": datetime.now().isoformat(),
+        "uptime_seconds": round(time.time() - START_TIME, 1),
+        "ready": is_ready(),
+        "warm_up": dict(readiness),
+        # Not loaded yet means nothing has needed them; don't load them here
+        "attendance_writer": attendance.get().writer.stats() if attendance.loaded else None,
+        "db_connections": attendance.get().db.stats() if attendance.loaded else None,
+        "metrics": REGISTRY.summary()
+    }
+
 @app.route('/health')
 def health_check():
-    return jsonify({
-        "status": "healthy",
-        "timestamp": datetime.now().isoformat()
-    })
+    return jsonify(health_status())
+
+# Prometheus scrape endpoint
+@app.route('/metrics')
+def metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+profiler = SamplingProfiler()
+
+@app.route('/debug/profiler', methods=['GET', 'POST'])
+def debug_profiler():
+    """
+    POST action=start [interval=seconds] / action=stop controls the sampling
+    profiler; GET returns the stacks collected so far in collapsed format
+    (feed to flamegraph.pl or speedscope). Disabled unless PROFILER_ENABLED.
+    """
+    if not app.config['PROFILER_ENABLED']:
+        return jsonify({"status": "error", "message": "Profiler is disabled"}), 404
+    if request.method == 'POST':
+        action = request.values.get('action')
+        if action == 'start':
+            profiler.interval = request.values.get('interval', profiler.interval, type=float)
+            profiler.start()
+        elif action == 'stop':
+            profiler.stop()
+        else:
+            return jsonify({"status": "error", "message": "action must be start or stop"}), 400
+        return jsonify({"status": "success", "running": profiler.running, "samples": profiler.samples})
+    return Response(profiler.collapsed(request.args.get('limit', type=int)), mimetype='text/plain')
 
 @app.route('/users')
 def view_users():
     try:
         db = get_db()
-        users = db.conn.execute('SELECT * FROM users').fetchall()
-        return render_template('users.html', users=users)
+        page_size = app.config['PAGE_SIZE']
+        after = request.args.get('after', 0, type=int)
+        # One extra row tells us whether there is a next page
+        users = db.get_users_page(after, page_size + 1)
+        next_url = None
+        if len(users) > page_size:
+            users = users[:page_size]
+            next_url = url_for('view_users', after=users[-1][0])
+        return render_template('users.html', users=users, next_url=next_url)
     except Exception as e:
         logging.error(f"Failed to fetch users: {str(e)}")
         return "Error loading user list", 500
@@ -272,25 +573,41 @@ def register():
             name = request.form['name']
             email = request.form.get('email')
             
-            # Get uploaded image
-            if 'image' not in request.files:
+            # Get uploaded images: several photos make a better template
+            images = [image for image in request.files.getlist('image') if image.filename]
+            if not images:
                 return "No image uploaded", 400
                 
-            image = request.files['image']
-            if image.filename == '':
-                return "No selected image", 400
-                
-            # Process image
-            img = face_recognition.load_image_file(image)
-            encodings = face_recognition.face_encodings(img)
+            import face_recognition
+
+            # Check every photo before paying for the encoder
+            encodings = []
+            rejected = []
+            for image in images:
+                img = face_recognition.load_image_file(image)
+                face_locations = face_recognition.face_locations(img)
+                error = check_enrollment_face(
+                    img, face_locations,
+                    min_face_size=app.config['ENROLL_MIN_FACE_SIZE'],
+                    min_sharpness=app.config['ENROLL_MIN_SHARPNESS']
+                )
+                if error:
+                    rejected.append(f"{image.filename}: {error}")
+                    continue
+                encodings.append(face_recognition.face_encodings(img, face_locations)[0])
             
             if not encodings:
-                return "No face found in image", 400
+                return "No usable photo. " + "; ".join(rejected), 400
+            if rejected:
+                app.logger.warning(f"Registration of {name} skipped photos: {'; '.join(rejected)}")
                 
-            # Save to database
+            # Save the user and all their encodings together
             db = get_db()
-            user_id = db.add_user(name, email)
-            db.add_face_encoding(user_id, encodings[0])
+            db.add_users_bulk([{'name': name, 'email': email, 'encodings': encodings}])
+            
+            # Make the new face recognizable on the next frame
+            with processing_lock:
+                get_cached_matcher()
             
             return redirect(url_for('index'))
             
@@ -299,6 +616,51 @@ def register():
             
     return render_template('register.html')
 
+@app.route('/register/bulk', methods=['POST'])
+def register_bulk():
+    """Enroll many users from an uploaded zip (`archive`) or a `directory` under BULK_IMPORT_ROOT."""
+    try:
+        if 'archive' in request.files and request.files['archive'].filename:
+            items = collect_zip(request.files['archive'].stream)
+        elif request.form.get('directory'):
+            root = app.config['BULK_IMPORT_ROOT']
+            if not root:
+                return jsonify({"status": "error", "message": "Importing from a server directory is disabled"}), 403
+            # Relative to the root; resolving symlinks and '..' first so neither can step outside it
+            root = os.path.realpath(root)
+            directory = os.path.realpath(os.path.join(root, request.form['directory']))
+            if os.path.commonpath([root, directory]) != root:
+                return jsonify({"status": "error", "message": "Directory is outside the import root"}), 403
+            if not os.path.isdir(directory):
+                return jsonify({"status": "error", "message": "Not a directory"}), 400
+            items = collect_directory(directory)
+        else:
+            return jsonify({"status": "error", "message": "Upload a zip archive or give a directory"}), 400
+            
+        if not items:
+            return jsonify({"status": "error", "message": "No images found"}), 400
+            
+        report = bulk_import(
+            get_db(),
+            items,
+            department=request.form.get('department') or None,
+            processes=app.config['BULK_IMPORT_WORKERS'],
+            min_face_size=app.config['ENROLL_MIN_FACE_SIZE'],
+            min_sharpness=app.config['ENROLL_MIN_SHARPNESS']
+        )
+        
+        # Make the new faces recognizable on the next frame
+        with processing_lock:
+            get_cached_matcher()
+        
+        return jsonify(dict(report, status="success"))
+        
+    except zipfile.BadZipFile:
+        return jsonify({"status": "error", "message": "Uploaded file is not a zip archive"}), 400
+    except Exception as e:
+        app.logger.error(f"Bulk registration failed: {str(e)}")
+        return jsonify({"status": "error", "message": f"Bulk registration failed: {str(e)}"}), 500
+
 @app.route('/attendance')
 def view_attendance():
     try:
@@ -309,43 +671,40 @@ def view_attendance():
         date = request.args.get('date')
         start_date = request.args.get('start_date')
         end_date = request.args.get('end_date')
+        before = request.args.get('before', type=int)
+        page_size = app.config['PAGE_SIZE']
         
-        # Base query
-        query = '''
-            SELECT u.name, a.timestamp 
-            FROM attendance_records a
-            JOIN users u ON a.user_id = u.user_id
-        '''
-        params = []
-        
-        # Apply filters
-        if filter_type == 'single' and date:
-            query += ' WHERE DATE(a.timestamp) = ?'
-            params.append(date)
-        elif filter_type == 'range' and start_date and end_date:
-            query += ' WHERE DATE(a.timestamp) BETWEEN ? AND ?'
-            params.extend([start_date, end_date])
-        
-        query += ' ORDER BY a.timestamp DESC'
-        
-        # Execute query
-        cursor = db.conn.cursor()
-        cursor.execute(query, params)
-        records = cursor.fetchall()
+        # Dates become half-open ranges on the local `day` column: [first day, day after the last)
+        start = end = None
+        try:
+            if filter_type == 'single' and date:
+                day = datetime.strptime(date, '%Y-%m-%d').date()
+                start, end = day.isoformat(), (day + timedelta(days=1)).isoformat()
+            elif filter_type == 'range' and start_date and end_date:
+                start = datetime.strptime(start_date, '%Y-%m-%d').date().isoformat()
+                last_day = datetime.strptime(end_date, '%Y-%m-%d').date()
+                end = (last_day + timedelta(days=1)).isoformat()
+        except ValueError:
+            flash('Invalid date', 'warning')
+            return redirect(url_for('view_attendance'))
         
-        # Format results
-        formatted_records = []
-        for name, timestamp in records:
-            dt = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S') if isinstance(timestamp, str) else timestamp
-            formatted_records.append({
-                'name': name,
-                'timestamp': dt,
-                'formatted_time': dt.strftime('%Y-%m-%d %H:%M')
-            })
+        records = db.get_attendance_page(start, end, before, page_size + 1)
+        next_url = None
+        if len(records) > page_size:
+            records = records[:page_size]
+            next_url = url_for(
+                'view_attendance',
+                **dict(request.args.to_dict(), before=records[-1][0])
+            )
         
         return render_template(
             'attendance.html',
-            records=formatted_records,
+            records=records,
+            next_url=next_url,
+            first_url=None if before is None else url_for(
+                'view_attendance',
+                **{k: v for k, v in request.args.items() if k != 'before'}
+            ),
             filter_type=filter_type,
             date=date,
             start_date=start_date,
@@ -361,9 +720,84 @@ def view_attendance():
         flash('An unexpected error occurred', 'danger')
         return redirect(url_for('index'))
 
+def report_filters():
+    """(start, end, department) from the query string; dates must be YYYY-MM-DD."""
+    start = request.args.get('start') or None
+    end = request.args.get('end') or None
+    for value in (start, end):
+        if value:
+            datetime.strptime(value, '%Y-%m-%d')
+    return start, end, request.args.get('department') or None
+
+@app.route('/reports/daily')
+def report_daily():
+    """Users present and check-ins per day and department."""
+    try:
+        rows = get_db().get_daily_summary(*report_filters())
+    except ValueError:
+        return jsonify({"status": "error", "message": "Dates must be YYYY-MM-DD"}), 400
+    return jsonify([
+        {"day": day, "department": department, "present": present, "check_ins": check_ins}
+        for day, department, present, check_ins in rows
+    ])
+
+@app.route('/reports/users')
+def report_users():
+    """Days present and first/last seen per user over the range."""
+    try:
+        rows = get_db().get_user_summary(*report_filters())
+    except ValueError:
+        return jsonify({"status": "error", "message": "Dates must be YYYY-MM-DD"}), 400
+    return jsonify([
+        {"user_id": user_id, "name": name, "department": department, "days_present": days,
+         "first_seen": first_seen, "last_seen": last_seen}
+        for user_id, name, department, days, first_seen, last_seen in rows
+    ])
+
+EXPORT_COLUMNS = ['day', 'user_id', 'name', 'department', 'first_seen', 'last_seen', 'check_ins']
+
+@app.route('/reports/export')
+def report_export():
+    """
+    Stream per-user-per-day attendance as CSV (default) or NDJSON
+    (`format=ndjson`). Rows are generated batch by batch, so memory use
+    does not grow with the size of the export.
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        return jsonify({"status": "error", "message": "format must be csv or ndjson"}), 400
+    try:
+        filters = report_filters()
+    except ValueError:
+        return jsonify({"status": "error", "message": "Dates must be YYYY-MM-DD"}), 400
+    batches = get_db().iter_daily_attendance(*filters)
+
+    def generate_csv():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        for rows in batches:
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    def generate_ndjson():
+        for rows in batches:
+            yield ''.join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n' for row in rows)
+
+    if export_format == 'csv':
+        body, mimetype, extension = generate_csv(), 'text/csv', 'csv'
+    else:
+        body, mimetype, extension = generate_ndjson(), 'application/x-ndjson', 'ndjson'
+    return Response(body, mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename=attendance.{extension}'
+    })
+
 # Entry point
 if __name__ == '__main__':
-    app.run(
+    create_app().run(
         host='0.0.0.0', 
         port=5000, 
         debug=True, 
@@ -0,0 +1,218 @@
+"""
+Asyncio (ASGI) serving mode for the same app, for many concurrent
+viewers and kiosks:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+    python asgi.py
+
+The endpoints that hold connections open or are polled hard run on the
+event loop:
+
+    /video_feed[/<camera>]        async generator over a FrameBroadcaster:
+                                  one pump thread per camera, however many
+                                  clients are watching
+    /mark_attendance[/<camera>]   matching and the DB commit run in a
+    /health, /pipeline_stats,     thread pool, so they never block the loop
+    /metrics
+
+Everything else (pages, registration, reports, static files) is the Flask
+app, mounted through a WSGI adapter. Recognition itself already runs on
+pipeline threads and worker processes in both modes.
+
+Needs starlette and uvicorn (pip install starlette uvicorn); the threaded
+Flask server (python app.py) does not.
+"""
+import asyncio
+import contextlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError:
+    # Deprecated in Starlette in favour of a2wsgi, but still shipped
+    from starlette.middleware.wsgi import WSGIMiddleware
+
+import app as flask_module
+from metrics import REGISTRY, gauge
+
+STREAM_CLIENTS = gauge('async_stream_clients', "Clients watching a camera through the asyncio server", ['camera'])
+
+
+class FrameBroadcaster:
+    """
+    Fans one camera's JPEG frames out to any number of asyncio clients.
+    A single pump thread subscribes to the PipelineManager (so threaded
+    and async clients share the same pipeline) and hands every frame to
+    the event loop. Clients always get the newest frame: a slow one skips
+    frames without holding up the others. Only touched from the event
+    loop, apart from the pump thread's call_soon_threadsafe.
+    """
+    def __init__(self, pipelines, camera):
+        self.pipelines = pipelines
+        self.camera = camera
+        self.clients = 0
+        self.frame = None
+        self.seq = 0
+        self.running = False
+        self._new_frame = asyncio.Event()
+        self._stop = None
+        self._clients_gauge = STREAM_CLIENTS.labels(camera=camera)
+
+    def _start(self):
+        loop = asyncio.get_running_loop()
+        self._stop = threading.Event()
+        self.frame = None
+        self.running = True
+        threading.Thread(
+            target=self._pump, args=(loop, self._stop),
+            name=f'broadcast-{self.camera}', daemon=True
+        ).start()
+
+    def _pump(self, loop, stop):
+        # `stop` also ends the subscription while no frames arrive (a stalled
+        # camera), so the pipeline is released once the last client leaves
+        frames = self.pipelines.subscribe(self.camera, cancel=stop)
+        try:
+            for jpeg in frames:
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(self._publish, jpeg, stop)
+        except Exception as e:
+            logging.error(f"Camera initialization failed: {str(e)}")
+        finally:
+            frames.close()
+            with contextlib.suppress(RuntimeError):  # Loop already closed on shutdown
+                loop.call_soon_threadsafe(self._finished, stop)
+
+    def _wake(self):
+        event, self._new_frame = self._new_frame, asyncio.Event()
+        event.set()
+
+    def _publish(self, jpeg, stop):
+        if stop is not self._stop:
+            return  # From a pump that has since been replaced
+        self.frame = jpeg
+        self.seq += 1
+        self._wake()
+
+    def _finished(self, stop):
+        if stop is self._stop:
+            # The camera stopped on its own: end every stream
+            self.running = False
+            self._wake()
+
+    async def frames(self):
+        """Yield JPEG frames for one client until the camera stops or the client leaves."""
+        self.clients += 1
+        self._clients_gauge.set(self.clients)
+        if not self.running:
+            self._start()
+        seq = self.seq - 1 if self.frame is not None else self.seq
+        try:
+            while True:
+                if self.seq != seq:
+                    seq = self.seq
+                    yield self.frame
+                elif not self.running:
+                    return
+                else:
+                    await self._new_frame.wait()
+        finally:
+            self.clients -= 1
+            self._clients_gauge.set(self.clients)
+            if self.clients == 0 and self.running:
+                self._stop.set()
+                self.running = False
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+        self.running = False
+        self._wake()
+
+
+def create_asgi_app(config=None):
+    """
+    Starlette app serving the hot endpoints natively and the rest of the
+    Flask app through WSGI. `config` goes to create_app() at startup.
+    """
+    flask_app = flask_module.app
+    broadcasters = {}
+    executor = None
+
+    async def run_blocking(function, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(executor, partial(function, *args, **kwargs))
+
+    def camera_or_default(request):
+        return request.path_params.get('camera') or flask_app.config['DEFAULT_CAMERA']
+
+    async def video_feed(request):
+        camera = camera_or_default(request)
+        if camera not in flask_app.config['CAMERAS']:
+            return PlainTextResponse(f"Unknown camera: {camera}", status_code=404)
+        broadcaster = broadcasters.get(camera)
+        if broadcaster is None:
+            broadcaster = broadcasters[camera] = FrameBroadcaster(flask_module.pipelines, camera)
+
+        async def multipart():
+            async for frame_bytes in broadcaster.frames():
+                yield (b'--frame\r\n'
+                       b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+
+        return StreamingResponse(multipart(), media_type='multipart/x-mixed-replace; boundary=frame')
+
+    async def mark_attendance(request):
+        payload, status = await run_blocking(flask_module.attendance_for_camera, camera_or_default(request))
+        return JSONResponse(payload, status_code=status)
+
+    async def health(request):
+        return JSONResponse(await run_blocking(flask_module.health_status))
+
+    async def pipeline_stats(request):
+        return JSONResponse(flask_module.pipelines.stats())
+
+    async def metrics(request):
+        return Response(await run_blocking(REGISTRY.render), media_type='text/plain; version=0.0.4')
+
+    @contextlib.asynccontextmanager
+    async def lifespan(starlette_app):
+        nonlocal executor
+        flask_module.create_app(config)
+        executor = ThreadPoolExecutor(
+            max_workers=flask_app.config['ASYNC_EXECUTOR_WORKERS'], thread_name_prefix='async-blocking')
+        logging.info("Asyncio server started")
+        try:
+            yield
+        finally:
+            for broadcaster in broadcasters.values():
+                broadcaster.stop()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    return Starlette(
+        routes=[
+            Route('/video_feed', video_feed),
+            Route('/video_feed/{camera}', video_feed),
+            Route('/mark_attendance', mark_attendance),
+            Route('/mark_attendance/{camera}', mark_attendance),
+            Route('/health', health),
+            Route('/pipeline_stats', pipeline_stats),
+            Route('/metrics', metrics),
+            Mount('/', app=WSGIMiddleware(flask_app)),
+        ],
+        lifespan=lifespan,
+    )
+
+
+app = create_asgi_app()
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(app, host='0.0.0.0', port=5000)
@@ -1,35 +1,66 @@
-from database import FaceDatabase
+from attendance_writer import AttendanceWriter
+from database import ConnectionPool
+from metrics import counter, histogram
 import logging
+import threading
 from datetime import datetime
 
-db=FaceDatabase()
+# Shared by the app and this module; each thread gets its own connection
+db=ConnectionPool('face_recognition.db')
 logging.basicConfig(filename='attendance.log',level=logging.INFO,format='%(asctime)s-%(message)s')
 
 
 
-def mark_attendance(user_id, name):
-    """Record attendance in the database"""
-    try:
-        
-        today = datetime.now().date()
-        existing = db.get_attendance_report(today)
-        present_today = any(record[0] == name for record in existing)
-        
-        if not present_today:
-            db.record_attendance(user_id)
-            logging.info(f"Marked attendance for {name}")
-            return True
-        else:
-            logging.warning(f"{name} already marked today")
+# Attendance inserts go through a background writer that batches commits
+writer = AttendanceWriter(db)
+
+ATTENDANCE_MARKS = counter('attendance_marks', "mark_attendance calls by outcome", ['result'])
+ATTENDANCE_SECONDS = histogram('attendance_mark_seconds', "mark_attendance latency", ['mode'])
+
+# user_ids already marked present today, so repeat recognitions of the
+# same person skip the database entirely. The unique (user_id, day) index
+# stays the source of truth across processes.
+present_today = set()
+present_day = None
+present_lock = threading.Lock()
+
+def _forget_if_failed(user_id, day, future):
+    """Let a user be marked again if their queued write did not commit."""
+    if future.exception() is not None:
+        with present_lock:
+            if present_day == day:
+                present_today.discard(user_id)
+
+def mark_attendance(user_id, name, wait=False, timeout=5.0):
+    """
+    Record attendance in the database. By default the insert is queued and
+    this returns True as soon as the user is newly seen today; pass
+    wait=True to block until it is committed and get the database's answer.
+    """
+    global present_day
+    with ATTENDANCE_SECONDS.labels(mode='wait' if wait else 'queued').time():
+        try:
+            today = datetime.now().date().isoformat()
+            with present_lock:
+                if present_day != today:
+                    present_today.clear()
+                    present_day = today
+                if user_id in present_today:
+                    ATTENDANCE_MARKS.labels(result='cached').inc()
+                    return False
+                present_today.add(user_id)
+
+            future = writer.submit(user_id, today, name)
+            future.add_done_callback(lambda f: _forget_if_failed(user_id, today, f))
+            if not wait:
+                ATTENDANCE_MARKS.labels(result='queued').inc()
+                return True
+            inserted = future.result(timeout)
+            if not inserted:
+                logging.warning(f"{name} already marked today")
+            ATTENDANCE_MARKS.labels(result='marked' if inserted else 'duplicate').inc()
+            return inserted
+        except Exception as e:
+            logging.error(f"Error marking attendance: {str(e)}")
+            ATTENDANCE_MARKS.labels(result='error').inc()
             return False
-    except Exception as e:
-        logging.error(f"Error marking attendance: {str(e)}")
-        return False
-
-def load_known_faces():
-    """Load encodings from database"""
-    encodings_data = db.get_all_encodings()
-    encodings = [data['encoding'] for data in encodings_data]
-    names = [data['name'] for data in encodings_data]
-    user_ids = [data['user_id'] for data in encodings_data]
-    return encodings, names, user_ids
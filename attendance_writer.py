@@ -0,0 +1,141 @@
+"""
+Write-behind queue for attendance records.
+
+Recognition threads hand attendance events to a single writer thread and
+carry on; the writer drains the queue and commits them in small batches,
+so a burst of check-ins costs one fsync per batch instead of one per
+person and never blocks the video pipeline on SQLite.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from metrics import gauge, histogram
+
+BATCH_SIZE = histogram('attendance_writer_batch_size', "Attendance events committed per batch",
+                       buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+WRITE_SECONDS = histogram('attendance_writer_commit_seconds', "Time to write and commit one batch")
+PENDING = gauge('attendance_writer_pending', "Attendance events waiting for the writer")
+
+_STOP = object()
+
+
+class AttendanceWriter:
+    """
+    Writes through its own pooled connection (WAL, synchronous=NORMAL, see
+    ConnectionPool) and commits queued (user_id, day) events once `batch_size` are waiting or the oldest has
+    waited `flush_interval` seconds, whichever comes first.
+    """
+    def __init__(self, pool, batch_size: int = 100, flush_interval: float = 0.2):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.written = 0
+        self._thread = threading.Thread(target=self._run, name='attendance-writer', daemon=True)
+        self._thread.start()
+        PENDING.set_function(self.pending)
+        atexit.register(self.close)
+
+    def submit(self, user_id: int, day: str, name: str = None) -> Future:
+        """
+        Queue one attendance event. The returned future resolves to True
+        once the record is committed, False if the user was already present
+        that day, or raises if the write failed.
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Attendance writer is closed")
+            self._queue.put((user_id, day, name, future))
+        return future
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def flush(self, timeout: float = None) -> bool:
+        """Wait until everything queued so far is committed. Returns False on timeout."""
+        done = threading.Event()
+        with self._lock:
+            if self._closed:
+                return not self._thread.is_alive()
+            self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout: float = 10.0):
+        """Commit whatever is still queued and stop the writer thread."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(_STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logging.error(f"Attendance writer did not finish within {timeout}s; "
+                          f"{self._queue.qsize()} events may be lost")
+
+    def _next_batch(self):
+        """Block for the first event, then gather more until the batch is full or due."""
+        batch, markers = [], []
+        item = self._queue.get()
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            if item is _STOP:
+                return batch, markers, True
+            if isinstance(item, threading.Event):
+                # A flush() marker: commit now so the caller isn't kept waiting
+                markers.append(item)
+                return batch, markers, False
+            batch.append(item)
+            remaining = deadline - time.monotonic()
+            if len(batch) >= self.batch_size or remaining <= 0:
+                return batch, markers, False
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                return batch, markers, False
+
+    def _run(self):
+        db = self.pool.get()
+        stopping = False
+        while not stopping:
+            batch, markers, stopping = self._next_batch()
+            if batch:
+                self._write(db, batch)
+            for marker in markers:
+                marker.set()
+
+    def _write(self, db, batch):
+        BATCH_SIZE.observe(len(batch))
+        try:
+            with WRITE_SECONDS.time():
+                results = db.record_attendance_batch([(user_id, day) for user_id, day, _, _ in batch])
+        except Exception as e:
+            logging.error(f"Error writing {len(batch)} attendance records: {str(e)}")
+            for _, _, _, future in batch:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        for (user_id, day, name, future), inserted in zip(batch, results):
+            if isinstance(inserted, Exception):
+                # Only this entry was rolled back; the rest of the batch committed
+                logging.error(f"Error writing attendance for {name or user_id}: {str(inserted)}")
+                future.set_exception(inserted)
+                continue
+            if inserted:
+                self.written += 1
+                logging.info(f"Marked attendance for {name or user_id}")
+            future.set_result(inserted)
+
+    def stats(self) -> dict:
+        return {
+            'pending': self.pending(),
+            'batches': self.batches,
+            'written': self.written,
+        }
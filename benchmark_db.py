@@ -0,0 +1,92 @@
+"""
+Request latency of /users and /attendance with a FaceDatabase opened per
+request (the old get_db) versus the per-thread ConnectionPool. Both
+routes are paginated, so every request reads one page (PAGE_SIZE rows).
+
+    python benchmark_db.py --users 1000 --records 10000 --requests 200
+"""
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+import numpy as np
+
+
+def populate(path: str, users: int, records: int, seed: int = 0):
+    """Fill a fresh database with `users` users and `records` attendance rows over the past year."""
+    from database import FaceDatabase
+
+    FaceDatabase(path).close()
+    rng = np.random.default_rng(seed)
+    conn = sqlite3.connect(path)
+    conn.executemany('INSERT INTO users (user_id, name, department) VALUES (?, ?, ?)',
+                     ((i, f"user{i}", f"dept{i % 10}") for i in range(1, users + 1)))
+    # One row per (user, day): draw distinct pairs
+    pairs = rng.choice(users * 365, size=min(records, users * 365), replace=False)
+    conn.executemany('''
+        INSERT INTO attendance_records (user_id, timestamp, day)
+        VALUES (?, DATETIME('now', ?), DATE('now', ?))
+    ''', ((int(p % users) + 1, f"-{p // users} days", f"-{p // users} days") for p in pairs))
+    conn.commit()
+    conn.close()
+
+
+def measure(client, url: str, requests: int) -> dict:
+    client.get(url)  # Warm up templates and caches
+    timings = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = client.get(url)
+        timings.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.status_code
+    timings = np.array(timings) * 1000
+    return {
+        'p50_ms': round(float(np.percentile(timings, 50)), 2),
+        'p99_ms': round(float(np.percentile(timings, 99)), 2),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    here = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        # The app opens face_recognition.db relative to the working directory
+        os.chdir(directory)
+        populate('face_recognition.db', args.users, args.records)
+
+        import app as app_module
+        from database import FaceDatabase
+        from flask import g
+
+        pooled_get_db = app_module.get_db
+
+        def per_request_get_db():
+            if 'bench_db' not in g:
+                g.bench_db = FaceDatabase()
+                g.bench_db._create_tables()
+            return g.bench_db
+
+        @app_module.app.teardown_appcontext
+        def close_per_request_db(e=None):
+            db = g.pop('bench_db', None)
+            if db is not None:
+                db.close()
+
+        # The HTML templates live next to app.py, not in a templates/ folder
+        app_module.app.template_folder = os.path.dirname(os.path.abspath(app_module.__file__))
+        client = app_module.app.test_client()
+        today = time.strftime('%Y-%m-%d')
+        urls = ['/users', f'/attendance?filter_type=single&date={today}', '/attendance']
+        for mode, get_db in (('per_request', per_request_get_db), ('pooled', pooled_get_db)):
+            app_module.get_db = get_db
+            for url in urls:
+                print(json.dumps(dict(measure(client, url, args.requests), mode=mode, url=url)))
+        os.chdir(here)
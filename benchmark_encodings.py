@@ -0,0 +1,93 @@
+"""
+Gallery load time and database size: legacy pickle BLOBs vs the binary
+encoding format, before and after running the fix_encodings.py migration.
+
+    python benchmark_encodings.py --sizes 10000 100000
+"""
+import argparse
+import json
+import os
+import pickle
+import sqlite3
+import tempfile
+import time
+
+import numpy as np
+
+from database import FaceDatabase
+from fix_encodings import fix_encodings
+from gallery import EMBEDDING_DIM, FaceGallery
+
+
+def create_legacy_db(path: str, size: int, seed: int = 0):
+    """Fill a fresh database with `size` users, each with one pickled float64 encoding."""
+    FaceDatabase(path).close()
+    rng = np.random.default_rng(seed)
+    conn = sqlite3.connect(path)
+    conn.executemany('INSERT INTO users (user_id, name) VALUES (?, ?)',
+                     ((i, f"user{i}") for i in range(1, size + 1)))
+    conn.executemany('INSERT INTO face_encodings (user_id, encoding) VALUES (?, ?)',
+                     ((i, pickle.dumps(rng.normal(0, 0.1, EMBEDDING_DIM))) for i in range(1, size + 1)))
+    conn.commit()
+    conn.execute('VACUUM')
+    conn.close()
+
+
+def time_load(path: str, loader, repeats: int = 3) -> float:
+    """Best-of-N seconds to build a gallery from the database."""
+    best = float('inf')
+    for _ in range(repeats):
+        db = FaceDatabase(path)
+        start = time.perf_counter()
+        gallery = loader(db)
+        best = min(best, time.perf_counter() - start)
+        db.close()
+    assert len(gallery) > 0
+    return best
+
+
+def load_from_records(db):
+    """The pre-migration code path: a dict per row, then one array per row."""
+    records = db.get_all_encodings()
+    gallery = FaceGallery(capacity=len(records))
+    gallery.extend(
+        [record['encoding'] for record in records],
+        [record['user_id'] for record in records],
+        [record['name'] for record in records],
+        [record['encoding_id'] for record in records]
+    )
+    return gallery
+
+
+def run(size: int, directory: str) -> dict:
+    path = os.path.join(directory, f"bench_{size}.db")
+    create_legacy_db(path, size)
+    before_bytes = os.path.getsize(path)
+    before_seconds = time_load(path, load_from_records)
+
+    start = time.perf_counter()
+    fix_encodings(path, batch_size=5000, vacuum=True)
+    migrate_seconds = time.perf_counter() - start
+
+    after_bytes = os.path.getsize(path)
+    after_seconds = time_load(path, FaceGallery.from_database)
+    os.remove(path)
+    return {
+        'encodings': size,
+        'db_mb_before': round(before_bytes / 2 ** 20, 2),
+        'db_mb_after': round(after_bytes / 2 ** 20, 2),
+        'load_ms_before': round(before_seconds * 1000, 1),
+        'load_ms_after': round(after_seconds * 1000, 1),
+        'migrate_s': round(migrate_seconds, 2),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = [run(size, directory) for size in args.sizes]
+    for result in results:
+        print(json.dumps(result))
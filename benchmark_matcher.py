@@ -0,0 +1,89 @@
+"""
+Recall-vs-latency benchmark of the IVF matcher against brute-force search.
+
+Uses a synthetic gallery shaped like face_recognition output (about 0.9
+between different people, about 0.35 between photos of the same person).
+
+    python benchmark_matcher.py --sizes 10000 50000 --probes 1 4 8 16
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from gallery import EMBEDDING_DIM, FaceGallery
+from matcher import ExactMatcher, IVFMatcher
+
+
+def synthetic_gallery(size: int, seed: int = 0):
+    """Return a gallery of `size` people plus one fresh query encoding per person."""
+    rng = np.random.default_rng(seed)
+    base = rng.normal(0, 0.1, EMBEDDING_DIM)
+    people = base + rng.normal(0, 0.65 / np.sqrt(EMBEDDING_DIM), (size, EMBEDDING_DIM))
+    enrolled = people + rng.normal(0, 0.25 / np.sqrt(EMBEDDING_DIM), people.shape)
+    queries = people + rng.normal(0, 0.25 / np.sqrt(EMBEDDING_DIM), people.shape)
+    gallery = FaceGallery(capacity=size)
+    gallery.extend(enrolled, np.arange(size), [f"user{i}" for i in range(size)])
+    return gallery, queries
+
+
+def time_search(matcher, queries):
+    """Search queries one at a time, like the video loop does. Returns (rows, latencies_ms)."""
+    rows = np.empty(len(queries), dtype=np.int64)
+    latencies = np.empty(len(queries))
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        found, _ = matcher.search(query, k=1)
+        latencies[i] = (time.perf_counter() - start) * 1000
+        rows[i] = found[0, 0]
+    return rows, latencies
+
+
+def summarize(latencies):
+    return {
+        'p50_ms': round(float(np.percentile(latencies, 50)), 4),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 4),
+    }
+
+
+def run(sizes, probes, num_queries: int, seed: int):
+    results = []
+    for size in sizes:
+        gallery, queries = synthetic_gallery(size, seed)
+        rng = np.random.default_rng(seed + 1)
+        picked = rng.choice(size, min(num_queries, size), replace=False)
+        queries = queries[picked]
+
+        exact_rows, exact_latencies = time_search(ExactMatcher(gallery), queries)
+        results.append({'size': size, 'matcher': 'exact', 'recall': 1.0, **summarize(exact_latencies)})
+
+        start = time.perf_counter()
+        index = IVFMatcher.build(gallery, seed=seed)
+        build_seconds = time.perf_counter() - start
+        for n_probe in probes:
+            index.n_probe = n_probe
+            rows, latencies = time_search(index, queries)
+            results.append({
+                'size': size,
+                'matcher': 'ivf',
+                'lists': len(index.centroids),
+                'n_probe': n_probe,
+                'build_s': round(build_seconds, 2),
+                # Recall@1 relative to brute force
+                'recall': round(float(np.mean(rows == exact_rows)), 4),
+                **summarize(latencies)
+            })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--probes', type=int, nargs='+', default=[1, 4, 8, 16, 32])
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for result in run(args.sizes, args.probes, args.queries, args.seed):
+        print(json.dumps(result))
@@ -0,0 +1,275 @@
+"""
+End-to-end benchmark of the recognition pipeline without a camera.
+
+Frames come from recorded video files or a synthetic image sequence and go
+through the same functions the live stream uses (recognize_frame with the
+configured detector and tracker, draw_detections, JPEG encoding), in one
+thread so every stage can be timed. After every recognized frame the result
+goes into a RecognitionHistory and /mark_attendance's attendance_for_camera
+runs against it, committing through the attendance writer as a kiosk click
+would. The gallery is a synthetic one of the requested size, stored through
+FaceDatabase in a temporary database.
+
+Not covered: RecognitionPipeline's capture, recognition and encoder threads
+and the hand-off between them (frame drops, queueing); benchmark_serving.py
+measures the running server end to end.
+
+    python benchmark_pipeline.py --video entrance.mp4 --gallery-sizes 1000 100000
+    python benchmark_pipeline.py --synthetic 300 --face-image alice.jpg
+
+Prints one JSON object per (source, gallery size) with per-stage p50/p99
+timings, FPS and end-to-end frame latency. `resize` is the cost of one
+detection-size resize measured on its own; detect and encode include their
+own resizes, as in the live code, so `resize` is left out of the frame
+latency and FPS. So is `attendance` (a separate request in the app);
+`attendance_results` counts its outcomes.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+STAGES = ['resize', 'detect', 'encode', 'match', 'draw', 'jpeg', 'attendance']
+
+
+def video_frames(path: str, limit: int = None):
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError(f"Cannot open video {path}")
+    count = 0
+    try:
+        while limit is None or count < limit:
+            ret, frame = capture.read()
+            if not ret:
+                break
+            count += 1
+            yield frame
+    finally:
+        capture.release()
+
+
+def synthetic_frames(count: int, width: int = 640, height: int = 480,
+                     face_image: str = None, seed: int = 0):
+    """
+    A noisy background, with `face_image` (if given) pasted at half frame
+    height and drifting left to right, so detection and tracking have a
+    real face to work on.
+    """
+    rng = np.random.default_rng(seed)
+    background = rng.integers(60, 120, (height, width, 3), dtype=np.uint8)
+    face = None
+    if face_image:
+        face = cv2.imread(face_image)
+        if face is None:
+            raise ValueError(f"Cannot read image {face_image}")
+        side = height // 2
+        face = cv2.resize(face, (side * face.shape[1] // face.shape[0], side))
+    for i in range(count):
+        frame = background.copy()
+        if face is not None:
+            span = max(1, width - face.shape[1])
+            x = (i * 4) % span
+            y = (height - face.shape[0]) // 2
+            frame[y:y + face.shape[0], x:x + face.shape[1]] = face
+        yield frame
+
+
+def populate_gallery(path: str, size: int, seed: int = 0):
+    """Enroll `size` synthetic users, one encoding each, through FaceDatabase."""
+    from benchmark_matcher import synthetic_gallery
+    from database import FaceDatabase
+
+    gallery, _ = synthetic_gallery(size, seed)
+    db = FaceDatabase(path)
+    batch = 5000
+    for start in range(0, size, batch):
+        db.add_users_bulk([
+            {'name': f"user{i}", 'department': 'benchmark', 'encodings': [gallery.matrix[i]]}
+            for i in range(start, min(size, start + batch))
+        ])
+    db.close()
+
+
+class RecordedPipelines:
+    """
+    Stands in for app.pipelines: every camera is a running pipeline whose
+    history holds the benchmark's recognition results.
+    """
+    running = True
+
+    def __init__(self, history_size: int):
+        from pipeline import RecognitionHistory
+
+        self.history = RecognitionHistory(history_size)
+
+    def get(self, camera):
+        return self
+
+
+def use_database(app_module, path: str):
+    """Point the gallery cache and the attendance writer at the database at `path`."""
+    from attendance_writer import AttendanceWriter
+    from database import ConnectionPool, FaceDatabase
+
+    gallery_cache = app_module.gallery_cache.get()
+    gallery_cache.db = FaceDatabase(path)
+    # Attendance rows reference users, so they must go to the same database
+    attendance_system = app_module.attendance.get()
+    attendance_system.writer.close()
+    attendance_system.db = ConnectionPool(path)
+    attendance_system.writer = AttendanceWriter(attendance_system.db)
+    with attendance_system.present_lock:
+        attendance_system.present_today.clear()
+
+
+def percentiles(values) -> dict:
+    if not values:
+        return {'p50_ms': None, 'p99_ms': None, 'mean_ms': None}
+    values = np.asarray(values) * 1000
+    return {
+        'p50_ms': round(float(np.percentile(values, 50)), 3),
+        'p99_ms': round(float(np.percentile(values, 99)), 3),
+        'mean_ms': round(float(values.mean()), 3),
+    }
+
+
+def run(app_module, frames, source: str) -> dict:
+    """
+    Push frames through recognition (every FRAME_SKIP_RATE-th), drawing and
+    JPEG encoding, marking attendance after each recognized frame.
+    """
+    from tracker import FaceTracker
+    from workers import _small_rgb
+
+    app = app_module.app
+    tracker = FaceTracker(reverify_interval=app.config['TRACK_REVERIFY_INTERVAL']) \
+        if app.config['FACE_TRACKING'] else None
+    detector = app_module.create_detector()
+    skip = max(1, app.config['FRAME_SKIP_RATE'])
+    jpeg_params = [int(cv2.IMWRITE_JPEG_QUALITY), 80]
+    camera = app.config['DEFAULT_CAMERA']
+    recorded = RecordedPipelines(app.config['RECOGNITION_HISTORY_SIZE'])
+    live_pipelines, app_module.pipelines = app_module.pipelines, recorded
+
+    samples = {stage: [] for stage in STAGES}
+    frame_latencies = []
+    recognition_latencies = []
+    faces = []
+    attendance_results = {}
+    face_count = frame_count = recognized = 0
+    started = time.perf_counter()
+    # The standalone resize and attendance calls are left out of FPS
+    excluded_seconds = 0.0
+    try:
+        for frame_id, frame in enumerate(frames):
+            if frame_id % skip == 0:
+                # Outside the frame's latency: the live path only resizes inside detect and encode
+                start = time.perf_counter()
+                _small_rgb(frame, detector.scale)
+                seconds = time.perf_counter() - start
+                samples['resize'].append(seconds)
+                excluded_seconds += seconds
+
+            frame_start = time.perf_counter()
+            if frame_id % skip == 0:
+                timings = {}
+                start = time.perf_counter()
+                faces = app_module.recognize_frame(frame, tracker, detector, timings)
+                recognition_latencies.append(time.perf_counter() - start)
+                for stage, seconds in timings.items():
+                    samples[stage].append(seconds)
+                face_count += len(faces)
+                recognized += 1
+
+            start = time.perf_counter()
+            annotated = frame.copy()
+            app_module.draw_detections(annotated, faces)
+            samples['draw'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            cv2.imencode('.jpg', annotated, jpeg_params)
+            samples['jpeg'].append(time.perf_counter() - start)
+
+            frame_latencies.append(time.perf_counter() - frame_start)
+            frame_count += 1
+
+            if frame_id % skip == 0:
+                recorded.history.append({'frame_id': frame_id, 'timestamp': time.time(), 'faces': faces})
+                start = time.perf_counter()
+                payload, _ = app_module.attendance_for_camera(camera)
+                seconds = time.perf_counter() - start
+                samples['attendance'].append(seconds)
+                excluded_seconds += seconds
+                attendance_results[payload['status']] = attendance_results.get(payload['status'], 0) + 1
+    finally:
+        app_module.pipelines = live_pipelines
+
+    elapsed = time.perf_counter() - started - excluded_seconds
+
+    return {
+        'source': source,
+        'frames': frame_count,
+        'recognized_frames': recognized,
+        'faces_per_recognized_frame': round(face_count / recognized, 2) if recognized else 0,
+        'fps': round(frame_count / elapsed, 2) if elapsed else None,
+        'recognition_fps': round(recognized / sum(recognition_latencies), 2) if recognition_latencies else None,
+        'frame_latency': percentiles(frame_latencies),
+        'recognition_latency': percentiles(recognition_latencies),
+        'stages': {stage: percentiles(values) for stage, values in samples.items()},
+        'attendance_results': attendance_results,
+        'detector': detector.stats(),
+        'tracker': tracker.stats() if tracker is not None else None,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--video', nargs='*', default=[], help="Recorded video files")
+    parser.add_argument('--max-frames', type=int, default=None)
+    parser.add_argument('--synthetic', type=int, default=0, help="Number of synthetic frames")
+    parser.add_argument('--frame-size', default='640x480')
+    parser.add_argument('--face-image', default=None, help="Photo pasted into synthetic frames")
+    parser.add_argument('--gallery-sizes', type=int, nargs='+', default=[1000])
+    parser.add_argument('--workers', type=int, default=0,
+                        help="Recognition worker processes (0 = in-process, the default, so stages are timed precisely)")
+    parser.add_argument('--config', default=None, help="JSON object of app.config overrides")
+    args = parser.parse_args()
+    if not args.video and not args.synthetic:
+        parser.error("give --video files and/or --synthetic N")
+    width, height = (int(value) for value in args.frame_size.split('x'))
+    videos = [os.path.abspath(path) for path in args.video]
+    face_image = os.path.abspath(args.face_image) if args.face_image else None
+
+    here = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        # The app opens its database, index and snapshot relative to the working directory
+        os.chdir(directory)
+        import app as app_module
+        app_module.app.config.update(json.loads(args.config) if args.config else {})
+        app_module.recognition_pool.set(
+            app_module.RecognitionWorkerPool(args.workers) if args.workers else None)
+        gallery_cache = app_module.gallery_cache.get()
+
+        for size in args.gallery_sizes:
+            # A separate database, snapshot and index per gallery size
+            path = os.path.join(directory, f"gallery_{size}.db")
+            populate_gallery(path, size)
+            app_module.app.config['ANN_INDEX_PATH'] = os.path.join(directory, f"face_index_{size}.npz")
+            use_database(app_module, path)
+            gallery_cache.snapshot_path = os.path.join(directory, f"gallery_{size}.snapshot")
+            gallery_cache.reload()
+
+            sources = [(path, video_frames(path, args.max_frames)) for path in videos]
+            if args.synthetic:
+                sources.append((f"synthetic:{args.synthetic}x{width}x{height}",
+                                synthetic_frames(args.synthetic, width, height, face_image)))
+            for source, frames in sources:
+                result = run(app_module, frames, source)
+                result['gallery_size'] = size
+                result['workers'] = args.workers
+                print(json.dumps(result), flush=True)
+        os.chdir(here)
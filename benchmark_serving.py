@@ -0,0 +1,196 @@
+"""
+Load test: how many concurrent /video_feed viewers and /mark_attendance
+kiosks the threaded Flask server and the asyncio server (asgi.py) sustain.
+
+Each server is started in a subprocess on a temporary database with a
+looping video file as its camera. For every level of --viewers, that many
+clients watch the stream while --pollers clients call /mark_attendance
+back to back for --duration seconds.
+
+    python benchmark_serving.py --video entrance.mp4 --viewers 10 50 100 200 --pollers 20
+
+Prints one JSON object per (server, viewers) with the median and worst
+per-viewer frame rate, the fraction of viewers that got frames, and the
+/mark_attendance throughput and p50/p99 latency, followed by a summary of
+the most viewers each server handled with every viewer served, a median
+of --min-fps or better and /mark_attendance p99 within --max-poll-p99-ms.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+SERVERS = ['threaded', 'asgi']
+
+
+def serve(mode: str, port: int, config: dict):
+    """Subprocess entry point: run one server until killed."""
+    if mode == 'threaded':
+        import app as app_module
+        app_module.create_app(config).run(host='127.0.0.1', port=port, threaded=True, use_reloader=False)
+    else:
+        import uvicorn
+        from asgi import create_asgi_app
+        uvicorn.run(create_asgi_app(config), host='127.0.0.1', port=port, log_level='warning')
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def request(port: int, path: str, timeout: float):
+    """One GET on a fresh connection; returns the status code."""
+    reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+    try:
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n".encode())
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), timeout)
+        return int(response.split(b' ', 2)[1])
+    finally:
+        writer.close()
+
+
+async def viewer(port: int, duration: float, timeout: float) -> int:
+    """Watch /video_feed for `duration` seconds; returns the number of frames received."""
+    frames = 0
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return 0
+    try:
+        writer.write(b"GET /video_feed HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        await writer.drain()
+        deadline = time.monotonic() + duration
+        tail = b''
+        while time.monotonic() < deadline:
+            try:
+                chunk = await asyncio.wait_for(reader.read(65536), max(0.01, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
+            # A boundary may straddle two reads
+            data = tail + chunk
+            frames += data.count(b'--frame\r\n')
+            tail = data[-9:].replace(b'--frame\r\n', b'')
+    except OSError:
+        pass
+    finally:
+        writer.close()
+    return frames
+
+
+async def poller(port: int, duration: float, timeout: float):
+    """Call /mark_attendance back to back; returns (latencies, errors)."""
+    latencies, errors = [], 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            # 400 (nobody in front of the camera) is a normal answer here
+            status = await request(port, '/mark_attendance', timeout)
+            if status >= 500:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - start)
+        except (OSError, asyncio.TimeoutError, ValueError, IndexError):
+            errors += 1
+    return latencies, errors
+
+
+async def load(port: int, viewers: int, pollers: int, duration: float, timeout: float) -> dict:
+    viewer_tasks = [asyncio.create_task(viewer(port, duration, timeout)) for _ in range(viewers)]
+    poller_tasks = [asyncio.create_task(poller(port, duration, timeout)) for _ in range(pollers)]
+    frames = await asyncio.gather(*viewer_tasks)
+    polls = await asyncio.gather(*poller_tasks)
+    fps = np.array(frames, dtype=float) / duration
+    latencies = np.array([latency for result, _ in polls for latency in result]) * 1000
+    return {
+        'viewers': viewers,
+        'viewer_fps_p50': round(float(np.median(fps)), 2) if viewers else None,
+        'viewer_fps_min': round(float(fps.min()), 2) if viewers else None,
+        'viewers_served': round(float(np.mean(fps > 0)), 3) if viewers else None,
+        'pollers': pollers,
+        'polls_per_second': round(len(latencies) / duration, 2),
+        'poll_p50_ms': round(float(np.percentile(latencies, 50)), 2) if len(latencies) else None,
+        'poll_p99_ms': round(float(np.percentile(latencies, 99)), 2) if len(latencies) else None,
+        'poll_errors': sum(errors for _, errors in polls),
+    }
+
+
+def wait_until_up(port: int, process, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            if asyncio.run(request(port, '/health', 5)) == 200:
+                return
+        except (OSError, asyncio.TimeoutError, ValueError, IndexError):
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Server did not come up")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--video', required=True, help="Video file used as the camera (looped in real time)")
+    parser.add_argument('--servers', nargs='+', choices=SERVERS, default=SERVERS)
+    parser.add_argument('--viewers', type=int, nargs='+', default=[10, 50, 100, 200])
+    parser.add_argument('--pollers', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=10.0, help="Seconds per load level")
+    parser.add_argument('--timeout', type=float, default=10.0)
+    parser.add_argument('--min-fps', type=float, default=10.0,
+                        help="Per-viewer frame rate (median) a load level must sustain to count")
+    parser.add_argument('--max-poll-p99-ms', type=float, default=500.0,
+                        help="/mark_attendance p99 latency a load level must stay within to count")
+    parser.add_argument('--workers', type=int, default=0, help="Recognition worker processes (0 = in-process)")
+    parser.add_argument('--serve', choices=SERVERS, help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--config', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port, json.loads(args.config))
+        sys.exit(0)
+
+    config = {
+        'CAMERAS': {'main': {'source': os.path.abspath(args.video), 'loop': True, 'realtime': True}},
+        'RECOGNITION_WORKERS': args.workers,
+    }
+    here = os.path.dirname(os.path.abspath(__file__))
+    capacity = {}
+    for mode in args.servers:
+        with tempfile.TemporaryDirectory() as directory:
+            port = free_port()
+            process = subprocess.Popen(
+                [sys.executable, os.path.join(here, 'benchmark_serving.py'),
+                 '--video', args.video, '--serve', mode, '--port', str(port), '--config', json.dumps(config)],
+                cwd=directory,
+                env=dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [here, os.environ.get('PYTHONPATH')]))),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            try:
+                wait_until_up(port, process)
+                capacity[mode] = 0
+                for viewers in args.viewers:
+                    result = asyncio.run(load(port, viewers, args.pollers, args.duration, args.timeout))
+                    result['server'] = mode
+                    print(json.dumps(result), flush=True)
+                    polls_ok = result['poll_p99_ms'] is None or result['poll_p99_ms'] <= args.max_poll_p99_ms
+                    if result['viewers_served'] == 1 and result['viewer_fps_p50'] >= args.min_fps and polls_ok:
+                        capacity[mode] = max(capacity[mode], viewers)
+            finally:
+                process.terminate()
+                process.wait()
+    print(json.dumps({'summary': 'max viewers within limits', 'min_fps': args.min_fps,
+                      'max_poll_p99_ms': args.max_poll_p99_ms, **capacity}))
@@ -0,0 +1,183 @@
+"""
+Bulk enrollment from a folder or zip archive of photos.
+
+Layout: one sub-folder per person, named after them, holding any number of
+photos (each becomes one stored encoding, averaged into the person's
+template). Loose photos at the top level are enrolled under their file
+name. Blurry, small or multi-face photos are skipped and reported.
+
+A person who is already enrolled (the same name, and the same department
+when one is given) gets the new photos added to their existing user, so
+an import can be re-run or topped up later. Names shared by several
+existing users are reported as conflicts and left alone.
+
+    photos/
+        Alice Smith/front.jpg
+        Alice Smith/side.jpg
+        Bob Jones.png
+
+    python bulk_import.py photos/ --department Sales
+    python bulk_import.py class_2024.zip --workers 8
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from enrollment import DEFAULT_MIN_FACE_SIZE, DEFAULT_MIN_SHARPNESS, check_enrollment_face
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.webp'}
+
+
+def _person_and_image(relative_path: str):
+    """Split 'Alice/front.jpg' -> ('Alice', ...) and 'Bob.png' -> ('Bob', ...)."""
+    parts = relative_path.replace('\\', '/').strip('/').split('/')
+    if len(parts) == 1:
+        return os.path.splitext(parts[0])[0], relative_path
+    return parts[-2], relative_path
+
+
+def _is_image(path: str) -> bool:
+    name = os.path.basename(path)
+    return not name.startswith('.') and os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+
+def collect_directory(directory: str):
+    """Return (person, image_label, path) for every photo under `directory`."""
+    items = []
+    for root, _, files in os.walk(directory):
+        for file_name in sorted(files):
+            path = os.path.join(root, file_name)
+            if _is_image(path):
+                person, label = _person_and_image(os.path.relpath(path, directory))
+                items.append((person, label, path))
+    return items
+
+
+def collect_zip(archive):
+    """Return (person, image_label, bytes) for every photo in a zip file or file-like object."""
+    items = []
+    with zipfile.ZipFile(archive) as zf:
+        for info in zf.infolist():
+            if info.is_dir() or not _is_image(info.filename) or '__MACOSX' in info.filename:
+                continue
+            person, label = _person_and_image(info.filename)
+            items.append((person, label, zf.read(info)))
+    return items
+
+
+def encode_image(item, min_face_size: int = DEFAULT_MIN_FACE_SIZE,
+                 min_sharpness: float = DEFAULT_MIN_SHARPNESS):
+    """
+    Worker: decode one photo, check it is fit to enroll and compute its
+    face encoding. Returns (person, label, encoding, error) with exactly
+    one of encoding/error set.
+    """
+    import face_recognition
+
+    person, label, source = item
+    try:
+        image = face_recognition.load_image_file(io.BytesIO(source) if isinstance(source, bytes) else source)
+        locations = face_recognition.face_locations(image)
+        # Rejected photos never reach the encoder
+        error = check_enrollment_face(image, locations, min_face_size, min_sharpness)
+        if error:
+            return person, label, None, error
+        encoding = face_recognition.face_encodings(image, locations)[0]
+        return person, label, encoding, None
+    except Exception as e:
+        return person, label, None, str(e)
+
+
+def bulk_import(db, items, department: str = None, processes: int = None,
+                min_face_size: int = DEFAULT_MIN_FACE_SIZE,
+                min_sharpness: float = DEFAULT_MIN_SHARPNESS) -> dict:
+    """
+    Encode `items` (from collect_directory/collect_zip) across a process pool
+    and store one user per new person with all their encodings in one
+    transaction; people already enrolled get the encodings added instead.
+    Photos failing the enrollment checks are reported as failures.
+    Returns a report with counts, per-image failures, conflicts and throughput.
+    """
+    start = time.perf_counter()
+    processes = processes or os.cpu_count() or 1
+    encodings_by_person = {}
+    failures = []
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        chunksize = max(1, len(items) // (processes * 4))
+        encode = partial(encode_image, min_face_size=min_face_size, min_sharpness=min_sharpness)
+        for person, label, encoding, error in executor.map(encode, items, chunksize=chunksize):
+            if error:
+                failures.append({'image': label, 'error': error})
+                logging.warning(f"Bulk import skipped {label}: {error}")
+            else:
+                encodings_by_person.setdefault(person, []).append(encoding)
+    encode_seconds = time.perf_counter() - start
+
+    existing = db.get_user_ids_by_name(encodings_by_person, department) if encodings_by_person else {}
+    users, updated, conflicts = [], [], []
+    for person, encodings in encodings_by_person.items():
+        matches = existing.get(person, [])
+        if not matches:
+            users.append({'name': person, 'department': department, 'encodings': encodings})
+        elif len(matches) == 1:
+            db.add_face_encodings(matches[0], encodings)
+            updated.append({'name': person, 'user_id': matches[0], 'encodings': len(encodings)})
+        else:
+            conflicts.append({'name': person, 'user_ids': matches,
+                              'error': f"{len(matches)} users already have this name"})
+            logging.warning(f"Bulk import skipped {person}: {len(matches)} users already have this name")
+    user_ids = db.add_users_bulk(users) if users else []
+    total_seconds = time.perf_counter() - start
+
+    report = {
+        'images': len(items),
+        'users': len(user_ids),
+        'updated_users': updated,
+        'encodings': sum(len(user['encodings']) for user in users) + sum(user['encodings'] for user in updated),
+        'failures': failures,
+        'conflicts': conflicts,
+        'workers': processes,
+        'encode_seconds': round(encode_seconds, 2),
+        'total_seconds': round(total_seconds, 2),
+        'images_per_second': round(len(items) / total_seconds, 2) if total_seconds else None,
+    }
+    logging.info(
+        f"Bulk import: {report['users']} new users, {len(updated)} updated, {report['encodings']} encodings, "
+        f"{len(failures)} failures, {len(conflicts)} conflicts in {report['total_seconds']}s"
+    )
+    return report
+
+
+if __name__ == '__main__':
+    from database import FaceDatabase
+
+    parser = argparse.ArgumentParser(description="Enroll users from a folder or zip of photos")
+    parser.add_argument('source', help="Directory or .zip archive")
+    parser.add_argument('--db', default='face_recognition.db')
+    parser.add_argument('--department', default=None)
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: all cores)")
+    parser.add_argument('--min-face-size', type=int, default=DEFAULT_MIN_FACE_SIZE,
+                        help="Reject faces smaller than this many pixels")
+    parser.add_argument('--min-sharpness', type=float, default=DEFAULT_MIN_SHARPNESS,
+                        help="Reject faces blurrier than this (variance of the Laplacian)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    if os.path.isdir(args.source):
+        items = collect_directory(args.source)
+    else:
+        items = collect_zip(args.source)
+
+    db = FaceDatabase(args.db)
+    try:
+        print(json.dumps(bulk_import(db, items, args.department, args.workers,
+                                     args.min_face_size, args.min_sharpness), indent=2))
+    finally:
+        db.close()
@@ -1,22 +1,115 @@
+import logging
 import sqlite3
 import pickle
+import struct
+import threading
+import uuid
 from datetime import datetime
 from logging.handlers import RotatingFileHandler
 
+import numpy as np
+
+from metrics import histogram, instrument_methods
+
+DB_CALL_SECONDS = histogram('db_call_seconds', "Time spent in FaceDatabase methods", ['method'])
+
+# Stored encoding format: 8-byte header (magic, format version, dtype code,
+# dimension) followed by the raw little-endian values.
+ENCODING_MAGIC = b'FENC'
+ENCODING_FORMAT_VERSION = 1
+ENCODING_HEADER = struct.Struct('<4sBcH')
+ENCODING_DTYPES = {b'f': np.dtype('<f4'), b'd': np.dtype('<f8')}
+# float32 keeps distances accurate to ~1e-7, far below match thresholds.
+DEFAULT_ENCODING_DTYPE = b'f'
+
+
+def serialize_encoding(encoding, dtype_code: bytes = DEFAULT_ENCODING_DTYPE) -> bytes:
+    """Pack a face encoding into the versioned raw binary format."""
+    values = np.asarray(encoding, dtype=ENCODING_DTYPES[dtype_code]).ravel()
+    header = ENCODING_HEADER.pack(ENCODING_MAGIC, ENCODING_FORMAT_VERSION, dtype_code, values.size)
+    return header + values.tobytes()
+
+
+def is_legacy_encoding(blob: bytes) -> bool:
+    """True for encodings stored with pickle before the binary format existed."""
+    return not blob.startswith(ENCODING_MAGIC)
+
+
+def deserialize_encoding(blob: bytes):
+    """
+    Unpack one stored encoding into a 1-D array. Legacy pickled rows are
+    still readable until fix_encodings.py has migrated them.
+    """
+    if is_legacy_encoding(blob):
+        return np.asarray(pickle.loads(blob))
+    magic, version, dtype_code, dim = ENCODING_HEADER.unpack_from(blob)
+    if version != ENCODING_FORMAT_VERSION or dtype_code not in ENCODING_DTYPES:
+        raise ValueError(f"Unsupported encoding format version={version} dtype={dtype_code!r}")
+    values = np.frombuffer(blob, dtype=ENCODING_DTYPES[dtype_code], offset=ENCODING_HEADER.size)
+    if values.size != dim:
+        raise ValueError(f"Encoding has {values.size} values, header says {dim}")
+    return values
+
+
+def deserialize_encodings(blobs, dtype=np.float32):
+    """
+    Unpack many stored encodings into one (N, dim) array. When every blob
+    shares the same header the whole result set is decoded with a single
+    np.frombuffer over the concatenated bytes.
+    """
+    if not blobs:
+        return np.empty((0, 0), dtype=dtype)
+    first = blobs[0]
+    row_size = len(first)
+    if not is_legacy_encoding(first) and all(len(blob) == row_size for blob in blobs):
+        rows = np.frombuffer(b''.join(blobs), dtype=np.uint8).reshape(len(blobs), row_size)
+        header = np.frombuffer(first[:ENCODING_HEADER.size], dtype=np.uint8)
+        if (rows[:, :ENCODING_HEADER.size] == header).all():
+            # Validates the header once for the whole batch
+            deserialize_encoding(first)
+            _, _, dtype_code, dim = ENCODING_HEADER.unpack_from(first)
+            values = np.ascontiguousarray(rows[:, ENCODING_HEADER.size:]).view(ENCODING_DTYPES[dtype_code])
+            return values.reshape(len(blobs), dim).astype(dtype, copy=False)
+    # Mixed formats (e.g. part-way through a migration): decode row by row
+    return np.stack([deserialize_encoding(blob) for blob in blobs]).astype(dtype, copy=False)
+
+
+# Applied to every pooled connection when it is opened.
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',      # Readers don't block the writer and vice versa
+    'synchronous': 'NORMAL',    # Safe with WAL; fsync at checkpoints, not every commit
+    'busy_timeout': 5000,       # ms to wait on a locked database before failing
+    'cache_size': -16000,       # Negative = KiB, i.e. 16 MB page cache per connection
+    'mmap_size': 268435456,     # Read pages through a 256 MB memory map
+    'foreign_keys': 'ON',
+}
+
+
+def connect(db_path: str, pragmas: dict = None) -> sqlite3.Connection:
+    """Open a connection with declared-type parsing and the given pragmas."""
+    conn = sqlite3.connect(
+        db_path,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+        check_same_thread=False
+    )
+    for name, value in (pragmas or {'foreign_keys': 'ON'}).items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    return conn
+
 
 class FaceDatabase:
     """
     Manages the face recognition database using SQLite.
     """
-    def __init__(self, db_path: str = 'face_recognition.db'):
+    def __init__(self, db_path: str = 'face_recognition.db', conn: sqlite3.Connection = None):
+        if conn is not None:
+            # Borrowed from a ConnectionPool, which owns it and has already set up the schema.
+            self.conn = conn
+            self._owns_connection = False
+            return
         # Connect to the SQLite database, enabling parsing of declared types (for TIMESTAMP).
-        self.conn = sqlite3.connect(
-            db_path,
-            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,check_same_thread=False
-            # check_same_thread=False  # Uncomment if using across multiple threads.
-        )
-        # Enforce foreign key constraints for referential integrity.
-        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.conn = connect(db_path)
+        self._owns_connection = True
         # Create tables if they don't exist.
         self._create_tables()
 
@@ -45,15 +138,230 @@ class FaceDatabase:
                 record_id   INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id     INTEGER NOT NULL,
                 timestamp   TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                day         TEXT,
                 FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
             )
         ''')
+        self._migrate_attendance_day(cursor)
+        # Random id for this database, so caches built from another file
+        # (e.g. before a reset) can be told apart from this one's.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS database_meta (
+                key         TEXT PRIMARY KEY,
+                value       TEXT NOT NULL
+            )
+        ''')
+        cursor.execute(
+            "INSERT OR IGNORE INTO database_meta (key, value) VALUES ('database_id', ?)", (uuid.uuid4().hex,))
+        # Append-only log of gallery changes so caches can apply deltas
+        # instead of reloading every encoding.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS gallery_changes (
+                change_id   INTEGER PRIMARY KEY AUTOINCREMENT,
+                encoding_id INTEGER NOT NULL,
+                user_id     INTEGER NOT NULL,
+                op          TEXT NOT NULL CHECK (op IN ('add', 'remove'))
+            )
+        ''')
+        # Triggers also fire for rows removed by ON DELETE CASCADE.
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_face_encoding_added
+            AFTER INSERT ON face_encodings
+            BEGIN
+                INSERT INTO gallery_changes (encoding_id, user_id, op)
+                VALUES (NEW.encoding_id, NEW.user_id, 'add');
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_face_encoding_removed
+            AFTER DELETE ON face_encodings
+            BEGIN
+                INSERT INTO gallery_changes (encoding_id, user_id, op)
+                VALUES (OLD.encoding_id, OLD.user_id, 'remove');
+            END
+        ''')
+        self._create_templates(cursor)
+        self._create_daily_aggregate(cursor)
         # Indexes to improve query performance.
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_email ON users(email)')
+        # Bulk import looks people up by name to add photos instead of duplicating them
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_name ON users(name)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_attendance_user ON attendance_records(user_id)')
+        # One attendance record per user per day, enforced by the database.
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_attendance_user_day ON attendance_records(user_id, day)')
+        # Serves day-range filters and newest-first paging (entries are ordered by (day, timestamp, rowid)).
+        cursor.execute('DROP INDEX IF EXISTS idx_attendance_timestamp')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_attendance_day ON attendance_records(day, timestamp)')
         self.conn.commit()
         cursor.close()
 
+    def _create_templates(self, cursor):
+        """
+        face_templates: one template per user for matching, the centroid
+        of all their encodings (which stay in face_encodings as
+        exemplars). Rewritten whenever a user's encodings change, and
+        template_changes logs the rewrites the way gallery_changes logs
+        encodings. Built from existing encodings when first created.
+        """
+        exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'face_templates'"
+        ).fetchone()
+        # Reading one user's encodings (and cascading deletes) without a scan
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_face_encodings_user ON face_encodings(user_id)')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS face_templates (
+                template_id     INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id         INTEGER NOT NULL UNIQUE,
+                template        BLOB NOT NULL,
+                encoding_count  INTEGER NOT NULL,
+                FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS template_changes (
+                change_id   INTEGER PRIMARY KEY AUTOINCREMENT,
+                template_id INTEGER NOT NULL,
+                user_id     INTEGER NOT NULL,
+                op          TEXT NOT NULL CHECK (op IN ('add', 'remove'))
+            )
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_face_template_added
+            AFTER INSERT ON face_templates
+            BEGIN
+                INSERT INTO template_changes (template_id, user_id, op)
+                VALUES (NEW.template_id, NEW.user_id, 'add');
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_face_template_removed
+            AFTER DELETE ON face_templates
+            BEGIN
+                INSERT INTO template_changes (template_id, user_id, op)
+                VALUES (OLD.template_id, OLD.user_id, 'remove');
+            END
+        ''')
+        if not exists:
+            self._update_templates(cursor)
+
+    def _update_templates(self, cursor, user_ids=None):
+        """
+        Recompute the templates of `user_ids` (every user when None) from
+        their stored encodings, inside the caller's transaction.
+        """
+        if user_ids is None:
+            user_ids = [row[0] for row in cursor.execute('SELECT user_id FROM users')]
+        encodings_by_user = {user_id: [] for user_id in user_ids}
+        user_ids = list(encodings_by_user)
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            cursor.execute(f'''
+                SELECT user_id, encoding FROM face_encodings
+                WHERE user_id IN ({','.join('?' * len(chunk))})
+            ''', chunk)
+            for user_id, encoding_blob in cursor.fetchall():
+                encodings_by_user[user_id].append(encoding_blob)
+        self._store_templates(cursor, encodings_by_user)
+
+    def _store_templates(self, cursor, encodings_by_user):
+        """
+        Replace the templates of the users in `encodings_by_user` (user_id
+        -> list of encodings, as arrays or stored BLOBs) with the centroid
+        of those encodings. Users with none lose their template.
+        """
+        user_ids = list(encodings_by_user)
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            cursor.execute(
+                f"DELETE FROM face_templates WHERE user_id IN ({','.join('?' * len(chunk))})", chunk)
+        templates = []
+        for user_id, encodings in encodings_by_user.items():
+            if not encodings:
+                continue
+            try:
+                if isinstance(encodings[0], bytes):
+                    matrix = deserialize_encodings(encodings)
+                else:
+                    matrix = np.asarray(encodings, dtype=np.float32)
+            except Exception as e:
+                # Leave the user unmatchable rather than fail the write; fix_encodings.py repairs the rows
+                logging.warning(f"Cannot build template for user {user_id}: {str(e)}")
+                continue
+            templates.append((user_id, serialize_encoding(matrix.mean(axis=0)), len(encodings)))
+        cursor.executemany('''
+            INSERT INTO face_templates (user_id, template, encoding_count)
+            VALUES (?, ?, ?)
+        ''', templates)
+
+    def _create_daily_aggregate(self, cursor):
+        """
+        attendance_daily: one row per user per day with first/last seen and
+        the number of check-ins, plus the user's department at the time.
+        Kept up to date by a trigger on attendance_records so reports read
+        a few rows per day instead of scanning every record. Backfilled
+        from existing records when first created.
+        """
+        exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'attendance_daily'"
+        ).fetchone()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS attendance_daily (
+                day         TEXT NOT NULL,
+                user_id     INTEGER NOT NULL,
+                department  TEXT,
+                first_seen  TIMESTAMP NOT NULL,
+                last_seen   TIMESTAMP NOT NULL,
+                check_ins   INTEGER NOT NULL DEFAULT 1,
+                PRIMARY KEY (day, user_id),
+                FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_daily_department ON attendance_daily(department, day)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_daily_user ON attendance_daily(user_id, day)')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_attendance_daily
+            AFTER INSERT ON attendance_records
+            BEGIN
+                INSERT INTO attendance_daily (day, user_id, department, first_seen, last_seen)
+                SELECT NEW.day, NEW.user_id, department, NEW.timestamp, NEW.timestamp
+                FROM users WHERE user_id = NEW.user_id
+                ON CONFLICT (day, user_id) DO UPDATE SET
+                    first_seen = MIN(first_seen, excluded.first_seen),
+                    last_seen = MAX(last_seen, excluded.last_seen),
+                    check_ins = check_ins + 1;
+            END
+        ''')
+        if not exists:
+            cursor.execute('''
+                INSERT INTO attendance_daily (day, user_id, department, first_seen, last_seen, check_ins)
+                SELECT ar.day, ar.user_id, u.department, MIN(ar.timestamp), MAX(ar.timestamp), COUNT(*)
+                FROM attendance_records ar
+                JOIN users u ON u.user_id = ar.user_id
+                WHERE ar.day IS NOT NULL
+                GROUP BY ar.day, ar.user_id
+            ''')
+
+    def _migrate_attendance_day(self, cursor):
+        """
+        Add and backfill the `day` column on databases created before it
+        existed. Duplicate same-day records (possible under the old
+        check-then-insert) are collapsed to the earliest one so the unique
+        index can be built.
+        """
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(attendance_records)')]
+        if 'day' in columns:
+            return
+        cursor.execute('ALTER TABLE attendance_records ADD COLUMN day TEXT')
+        cursor.execute("UPDATE attendance_records SET day = DATE(timestamp, 'localtime')")
+        cursor.execute('''
+            DELETE FROM attendance_records
+            WHERE record_id NOT IN (
+                SELECT MIN(record_id) FROM attendance_records GROUP BY user_id, day
+            )
+        ''')
+        if cursor.rowcount:
+            logging.warning(f"Removed {cursor.rowcount} duplicate same-day attendance records")
+
     def add_user(self, name: str, email: str = None, department: str = None) -> int:
         """
         Add a new user and return the generated user_id.
@@ -68,73 +376,552 @@ class FaceDatabase:
         cursor.close()
         return user_id
 
-    def add_face_encoding(self, user_id: int, encoding) -> None:
+    def add_users_bulk(self, users) -> list:
         """
-        Store a face encoding (e.g. a list or array) for the given user.
+        Add several users and all their face encodings in one transaction.
+        `users` is a list of dicts with 'name', optional 'email' and
+        'department', and a list of 'encodings'. Returns the new user_ids.
         """
-        # Serialize the encoding to bytes.
-        encoding_blob = pickle.dumps(encoding)
         cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT INTO face_encodings (user_id, encoding) 
-            VALUES (?, ?)
-        ''', (user_id, encoding_blob))
+        try:
+            user_ids = []
+            for user in users:
+                cursor.execute('''
+                    INSERT INTO users (name, email, department)
+                    VALUES (?, ?, ?)
+                ''', (user['name'], user.get('email'), user.get('department')))
+                user_ids.append(cursor.lastrowid)
+            cursor.executemany('''
+                INSERT INTO face_encodings (user_id, encoding)
+                VALUES (?, ?)
+            ''', (
+                (user_id, serialize_encoding(encoding))
+                for user_id, user in zip(user_ids, users)
+                for encoding in user['encodings']
+            ))
+            # New users: their templates come straight from the encodings in hand
+            self._store_templates(cursor, {
+                user_id: user['encodings'] for user_id, user in zip(user_ids, users)
+            })
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        return user_ids
+
+    def get_user_ids_by_name(self, names, department: str = None) -> dict:
+        """
+        Existing users called one of `names` (and in `department`, if
+        given), as {name: [user_id, ...]}; names nobody has are left out.
+        """
+        names = list(dict.fromkeys(names))
+        found = {}
+        cursor = self.conn.cursor()
+        for start in range(0, len(names), 500):
+            chunk = names[start:start + 500]
+            query = f"SELECT name, user_id FROM users WHERE name IN ({','.join('?' * len(chunk))})"
+            params = list(chunk)
+            if department is not None:
+                query += ' AND department = ?'
+                params.append(department)
+            for name, user_id in cursor.execute(query + ' ORDER BY user_id', params):
+                found.setdefault(name, []).append(user_id)
+        cursor.close()
+        return found
+
+    def delete_user(self, user_id: int) -> None:
+        """
+        Delete a user; their encodings and attendance are removed by cascade.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
         self.conn.commit()
         cursor.close()
 
+    def add_face_encoding(self, user_id: int, encoding) -> int:
+        """
+        Store a face encoding (e.g. a list or array) for the given user
+        and return the generated encoding_id.
+        """
+        return self.add_face_encodings(user_id, [encoding])[0]
+
+    def add_face_encodings(self, user_id: int, encodings) -> list:
+        """
+        Store several face encodings for one user and update their
+        template, in one transaction. Returns the new encoding_ids.
+        """
+        cursor = self.conn.cursor()
+        try:
+            encoding_ids = []
+            for encoding in encodings:
+                cursor.execute('''
+                    INSERT INTO face_encodings (user_id, encoding)
+                    VALUES (?, ?)
+                ''', (user_id, serialize_encoding(encoding)))
+                encoding_ids.append(cursor.lastrowid)
+            self._update_templates(cursor, [user_id])
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        return encoding_ids
+
+    def delete_face_encoding(self, encoding_id: int) -> None:
+        """
+        Delete a single stored face encoding and update its user's template.
+        """
+        cursor = self.conn.cursor()
+        try:
+            row = cursor.execute(
+                'SELECT user_id FROM face_encodings WHERE encoding_id = ?', (encoding_id,)).fetchone()
+            cursor.execute('DELETE FROM face_encodings WHERE encoding_id = ?', (encoding_id,))
+            if row is not None:
+                self._update_templates(cursor, [row[0]])
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def rebuild_templates(self) -> None:
+        """
+        Recompute every user's template, e.g. after encodings were changed
+        outside this class.
+        """
+        cursor = self.conn.cursor()
+        try:
+            self._update_templates(cursor)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
     def get_all_encodings(self):
         """
         Retrieve all face encodings with corresponding user_id and name.
-        Returns a list of dicts: [{'user_id': ..., 'name': ..., 'encoding': ...}, ...].
+        Returns a list of dicts:
+        [{'encoding_id': ..., 'user_id': ..., 'name': ..., 'encoding': ...}, ...].
         """
         cursor = self.conn.cursor()
         cursor.execute('''
-            SELECT u.user_id, u.name, fe.encoding
+            SELECT fe.encoding_id, u.user_id, u.name, fe.encoding
             FROM face_encodings fe
             JOIN users u ON fe.user_id = u.user_id
         ''')
         rows = cursor.fetchall()
         cursor.close()
         encodings = []
-        for (user_id, name, encoding_blob) in rows:
-            encoding = pickle.loads(encoding_blob)
-            encodings.append({'user_id': user_id, 'name': name, 'encoding': encoding})
+        for (encoding_id, user_id, name, encoding_blob) in rows:
+            encoding = deserialize_encoding(encoding_blob)
+            encodings.append({
+                'encoding_id': encoding_id,
+                'user_id': user_id,
+                'name': name,
+                'encoding': encoding
+            })
         return encodings
 
-    def record_attendance(self, user_id: int) -> None:
+    def get_encoding_matrix(self):
+        """
+        Retrieve all face encodings as arrays rather than per-row dicts.
+        Returns (encoding_ids, user_ids, names, matrix) where matrix is an
+        (N, dim) float32 array decoded in one pass.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT fe.encoding_id, u.user_id, u.name, fe.encoding
+            FROM face_encodings fe
+            JOIN users u ON fe.user_id = u.user_id
+        ''')
+        rows = cursor.fetchall()
+        cursor.close()
+        if not rows:
+            return [], [], [], np.empty((0, 0), dtype=np.float32)
+        encoding_ids, user_ids, names, blobs = zip(*rows)
+        return list(encoding_ids), list(user_ids), list(names), deserialize_encodings(blobs)
+
+    def get_template_matrix(self):
+        """
+        Retrieve every user's template, in the same shape as
+        get_encoding_matrix: (template_ids, user_ids, names, matrix).
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT ft.template_id, u.user_id, u.name, ft.template
+            FROM face_templates ft
+            JOIN users u ON ft.user_id = u.user_id
+        ''')
+        rows = cursor.fetchall()
+        cursor.close()
+        if not rows:
+            return [], [], [], np.empty((0, 0), dtype=np.float32)
+        template_ids, user_ids, names, blobs = zip(*rows)
+        return list(template_ids), list(user_ids), list(names), deserialize_encodings(blobs)
+
+    def get_database_id(self) -> str:
+        """Random id generated when this database was created."""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT value FROM database_meta WHERE key = 'database_id'")
+        database_id = cursor.fetchone()[0]
+        cursor.close()
+        return database_id
+
+    def get_gallery_version(self) -> int:
+        """
+        Return the id of the latest gallery change (0 if none).
+        Cheap enough to poll on every frame.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT COALESCE(MAX(change_id), 0) FROM gallery_changes')
+        version = cursor.fetchone()[0]
+        cursor.close()
+        return version
+
+    def get_gallery_changes(self, since_version: int):
+        """
+        Retrieve gallery changes newer than `since_version`, oldest first.
+        Returns a list of dicts with 'change_id', 'op', 'encoding_id', 'user_id',
+        'name' and 'encoding' (None once the encoding has been deleted).
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT gc.change_id, gc.op, gc.encoding_id, gc.user_id, u.name, fe.encoding
+            FROM gallery_changes gc
+            LEFT JOIN face_encodings fe ON fe.encoding_id = gc.encoding_id
+            LEFT JOIN users u ON u.user_id = gc.user_id
+            WHERE gc.change_id > ?
+            ORDER BY gc.change_id
+        ''', (since_version,))
+        rows = cursor.fetchall()
+        cursor.close()
+        changes = []
+        for (change_id, op, encoding_id, user_id, name, encoding_blob) in rows:
+            changes.append({
+                'change_id': change_id,
+                'op': op,
+                'encoding_id': encoding_id,
+                'user_id': user_id,
+                'name': name,
+                'encoding': deserialize_encoding(encoding_blob) if encoding_blob is not None else None
+            })
+        return changes
+
+    def get_template_version(self) -> int:
+        """Return the id of the latest template change (0 if none)."""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT COALESCE(MAX(change_id), 0) FROM template_changes')
+        version = cursor.fetchone()[0]
+        cursor.close()
+        return version
+
+    def get_template_changes(self, since_version: int):
+        """
+        Retrieve template changes newer than `since_version`, oldest first,
+        in the same shape as get_gallery_changes: the template_id is given
+        as 'encoding_id' (it keys the gallery row) and the template as
+        'encoding'.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT tc.change_id, tc.op, tc.template_id, tc.user_id, u.name, ft.template
+            FROM template_changes tc
+            LEFT JOIN face_templates ft ON ft.template_id = tc.template_id
+            LEFT JOIN users u ON u.user_id = tc.user_id
+            WHERE tc.change_id > ?
+            ORDER BY tc.change_id
+        ''', (since_version,))
+        rows = cursor.fetchall()
+        cursor.close()
+        return [
+            {
+                'change_id': change_id,
+                'op': op,
+                'encoding_id': template_id,
+                'user_id': user_id,
+                'name': name,
+                'encoding': deserialize_encoding(template_blob) if template_blob is not None else None
+            }
+            for (change_id, op, template_id, user_id, name, template_blob) in rows
+        ]
+
+    def record_attendance(self, user_id: int, day: str = None) -> bool:
         """
         Record attendance for the specified user with the current timestamp.
+        `day` (YYYY-MM-DD, default today) is the local calendar day the
+        record counts for. Returns False if the user was already marked
+        present that day.
         """
+        day = day or datetime.now().date().isoformat()
         cursor = self.conn.cursor()
         cursor.execute('''
-            INSERT INTO attendance_records (user_id)
-            VALUES (?)
-        ''', (user_id,))
+            INSERT OR IGNORE INTO attendance_records (user_id, day)
+            VALUES (?, ?)
+        ''', (user_id, day))
+        inserted = cursor.rowcount == 1
         self.conn.commit()
         cursor.close()
+        return inserted
+
+    def record_attendance_batch(self, entries) -> list:
+        """
+        Record several (user_id, day) entries in a single transaction.
+        Returns one result per entry: True if it was recorded, False where
+        the user was already present that day, or the sqlite3.Error it
+        raised. Each entry runs in its own savepoint, so a bad one (e.g. a
+        since-deleted user) is rolled back alone and the rest still commit.
+        """
+        cursor = self.conn.cursor()
+        try:
+            results = []
+            for user_id, day in entries:
+                cursor.execute('SAVEPOINT attendance_entry')
+                try:
+                    cursor.execute('''
+                        INSERT OR IGNORE INTO attendance_records (user_id, day)
+                        VALUES (?, ?)
+                    ''', (user_id, day))
+                    results.append(cursor.rowcount == 1)
+                except sqlite3.Error as e:
+                    cursor.execute('ROLLBACK TO attendance_entry')
+                    results.append(e)
+                cursor.execute('RELEASE attendance_entry')
+            self.conn.commit()
+            return results
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def get_attendance_page(self, start: str = None, end: str = None,
+                            before_id: int = None, limit: int = 50):
+        """
+        Newest-first attendance records with `start` <= day < `end` (either
+        bound optional, 'YYYY-MM-DD' strings), continuing after record
+        `before_id` from the previous page. Filtering on the local `day`
+        rather than the UTC timestamp keeps this in line with the reports. Returns a list of
+        rows (record_id, name, formatted_time) with the time formatted by
+        SQLite as local 'YYYY-MM-DD HH:MM', like `day`.
+        """
+        query = '''
+            SELECT a.record_id, u.name, strftime('%Y-%m-%d %H:%M', a.timestamp, 'localtime') AS formatted_time
+            FROM attendance_records a
+            JOIN users u ON a.user_id = u.user_id
+            WHERE 1 = 1
+        '''
+        params = []
+        # Plain comparisons on the column (no DATE() around it) can use the index
+        if start:
+            query += ' AND a.day >= ?'
+            params.append(start)
+        if end:
+            query += ' AND a.day < ?'
+            params.append(end)
+        if before_id is not None:
+            query += '''
+                AND (a.day, a.timestamp, a.record_id) <
+                    (SELECT day, timestamp, record_id FROM attendance_records WHERE record_id = ?)
+            '''
+            params.append(before_id)
+        query += ' ORDER BY a.day DESC, a.timestamp DESC, a.record_id DESC LIMIT ?'
+        params.append(limit)
+        cursor = self.conn.cursor()
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
+
+    def get_users_page(self, after_id: int = 0, limit: int = 50):
+        """
+        Up to `limit` users with user_id > `after_id`, in id order, as
+        (user_id, name, email, department) tuples.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT user_id, name, email, department FROM users
+            WHERE user_id > ? ORDER BY user_id LIMIT ?
+        ''', (after_id, limit))
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
+
+    @staticmethod
+    def _daily_filters(start: str = None, end: str = None, department: str = None):
+        """WHERE clause and params over attendance_daily d for an inclusive day range."""
+        clauses, params = [], []
+        if start:
+            clauses.append('d.day >= ?')
+            params.append(start)
+        if end:
+            clauses.append('d.day <= ?')
+            params.append(end)
+        if department:
+            clauses.append('d.department = ?')
+            params.append(department)
+        return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+    def get_daily_summary(self, start: str = None, end: str = None, department: str = None):
+        """
+        Users present and total check-ins per day and department between
+        `start` and `end` (inclusive YYYY-MM-DD). Returns a list of
+        (day, department, present, check_ins) tuples.
+        """
+        where, params = self._daily_filters(start, end, department)
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+            SELECT d.day, d.department, COUNT(*) AS present, SUM(d.check_ins) AS check_ins
+            FROM attendance_daily d{where}
+            GROUP BY d.day, d.department
+            ORDER BY d.day, d.department
+        ''', params)
+        results = cursor.fetchall()
+        cursor.close()
+        return results
+
+    def get_user_summary(self, start: str = None, end: str = None, department: str = None):
+        """
+        Per-user totals between `start` and `end` (inclusive). Returns a list
+        of (user_id, name, department, days_present, first_seen, last_seen),
+        the times in local time like `day`.
+        """
+        where, params = self._daily_filters(start, end, department)
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+            SELECT d.user_id, u.name, d.department, COUNT(*) AS days_present,
+                   strftime('%Y-%m-%d %H:%M:%S', MIN(d.first_seen), 'localtime') AS first_seen,
+                   strftime('%Y-%m-%d %H:%M:%S', MAX(d.last_seen), 'localtime') AS last_seen
+            FROM attendance_daily d
+            JOIN users u ON u.user_id = d.user_id{where}
+            GROUP BY d.user_id
+            ORDER BY days_present DESC, u.name
+        ''', params)
+        results = cursor.fetchall()
+        cursor.close()
+        return results
+
+    def iter_daily_attendance(self, start: str = None, end: str = None,
+                              department: str = None, batch_size: int = 1000):
+        """
+        Yield lists of up to `batch_size` rows (day, user_id, name, department,
+        first_seen, last_seen, check_ins) ordered by day and user, with
+        times in local time like `day`, reading
+        with fetchmany so exports of any size run in constant memory.
+        """
+        where, params = self._daily_filters(start, end, department)
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(f'''
+                SELECT d.day, d.user_id, u.name, d.department,
+                       strftime('%Y-%m-%d %H:%M:%S', d.first_seen, 'localtime') AS first_seen,
+                       strftime('%Y-%m-%d %H:%M:%S', d.last_seen, 'localtime') AS last_seen,
+                       d.check_ins
+                FROM attendance_daily d
+                JOIN users u ON u.user_id = d.user_id{where}
+                ORDER BY d.day, d.user_id
+            ''', params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
 
     def get_attendance_report(self, date: str = None):
         """
         Generate an attendance report. If a date (YYYY-MM-DD) is given, filter by that date.
-        Returns a list of (name, attendance_count) tuples.
+        Returns a list of (name, attendance_count) tuples, counting days present.
         """
         cursor = self.conn.cursor()
         query = '''
-            SELECT u.name, COUNT(ar.record_id) AS attendance_count
+            SELECT u.name, COUNT(d.day) AS attendance_count
             FROM users u
-            LEFT JOIN attendance_records ar ON u.user_id = ar.user_id
+            LEFT JOIN attendance_daily d ON u.user_id = d.user_id
         '''
         params = ()
         if date:
-            query += ' WHERE DATE(ar.timestamp) = ?'
+            query += ' AND d.day = ?'
             params = (date,)
-        query += ' GROUP BY u.name ORDER BY attendance_count DESC'
+        query += ' GROUP BY u.user_id ORDER BY attendance_count DESC'
         cursor.execute(query, params)
         results = cursor.fetchall()
         cursor.close()
         return results
 
     def close(self):
-        """Close the database connection."""
-        if self.conn:
-            self.conn.close()
\ No newline at end of file
+        """Close the database connection (pooled connections stay open)."""
+        if self.conn and self._owns_connection:
+            self.conn.close()
+
+
+instrument_methods(FaceDatabase, DB_CALL_SECONDS, exclude=('close',))
+
+
+class ConnectionPool:
+    """
+    Long-lived per-thread FaceDatabase connections to one database file.
+
+    Each thread gets its own connection, configured once with `pragmas`
+    when opened. A connection left behind by a thread that has exited is
+    handed to the next new thread instead of opening another, so servers
+    that start a thread per request reuse a handful of connections. The
+    schema is created once, when the pool is constructed.
+
+    FaceDatabase methods called on the pool itself run on the calling
+    thread's connection, so a pool can be used wherever a shared
+    FaceDatabase was.
+    """
+    def __init__(self, db_path: str = 'face_recognition.db', pragmas: dict = None):
+        self.db_path = db_path
+        self.pragmas = dict(DEFAULT_PRAGMAS, **(pragmas or {}))
+        self._local = threading.local()
+        self._by_thread = {}
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.get()._create_tables()
+
+    def get(self) -> FaceDatabase:
+        """The calling thread's FaceDatabase."""
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            return db
+        thread = threading.current_thread()
+        with self._lock:
+            for owner, candidate in list(self._by_thread.items()):
+                if not owner.is_alive():
+                    del self._by_thread[owner]
+                    db = candidate
+                    break
+            else:
+                db = FaceDatabase(self.db_path, conn=connect(self.db_path, self.pragmas))
+                self.opened += 1
+            self._by_thread[thread] = db
+        if db.conn.in_transaction:
+            # Whatever the previous owner left uncommitted
+            db.conn.rollback()
+        self._local.db = db
+        return db
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'connections': len(self._by_thread), 'opened': self.opened}
+
+    def close(self):
+        """Close every pooled connection."""
+        with self._lock:
+            for db in self._by_thread.values():
+                db.conn.close()
+            self._by_thread.clear()
+        self._local = threading.local()
\ No newline at end of file
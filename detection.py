@@ -0,0 +1,115 @@
+def _merge_regions(regions):
+    """Union overlapping (top, right, bottom, left) boxes so no area is scanned twice."""
+    merged = []
+    for region in sorted(regions, key=lambda box: box[3]):
+        top, right, bottom, left = region
+        for i, (m_top, m_right, m_bottom, m_left) in enumerate(merged):
+            if left < m_right and right > m_left and top < m_bottom and bottom > m_top:
+                merged[i] = (min(top, m_top), max(right, m_right), max(bottom, m_bottom), min(left, m_left))
+                break
+        else:
+            merged.append(region)
+    if len(merged) < len(regions):
+        # A union can grow into a neighbour it did not overlap before
+        return _merge_regions(merged)
+    return merged
+
+
+class FaceDetector:
+    """
+    Decides, per frame, which detector to run, at what scale and over which
+    part of the frame.
+
+    - model / upsample: passed to face_recognition.face_locations ('hog' on
+      CPU, 'cnn' if dlib has CUDA; upsampling finds smaller faces at ~4x
+      the cost per step).
+    - target_fps: when set, the scale adapts between min_scale and
+      max_scale so the measured per-frame recognition latency stays within
+      1 / target_fps. Spare time is spent on resolution, which is what
+      finds faces at a distance.
+    - roi: (top, right, bottom, left) as fractions of the frame; only this
+      region (e.g. the doorway) is ever scanned.
+    - track_regions: scan only around the previous frame's faces, grown
+      by `region_margin` of their size, with a full scan (of the ROI, or
+      the whole frame) every `full_scan_interval` frames to pick up
+      newcomers.
+    """
+    def __init__(self, model: str = 'hog', upsample: int = 1, scale: float = 0.25,
+                 min_scale: float = 0.1, max_scale: float = 1.0, target_fps: float = None,
+                 roi=None, track_regions: bool = False, full_scan_interval: int = 10,
+                 region_margin: float = 0.5):
+        self.model = model
+        self.upsample = upsample
+        self.scale = scale
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.target_fps = target_fps
+        self.roi = roi
+        self.track_regions = track_regions
+        self.full_scan_interval = max(1, full_scan_interval)
+        self.region_margin = region_margin
+        self._previous = []
+        self._since_full_scan = None
+        self.latency = None
+        self.counters = {'frames': 0, 'full_scans': 0, 'region_scans': 0}
+
+    def _roi_box(self, frame_shape):
+        height, width = frame_shape[:2]
+        if self.roi is None:
+            return (0, width, height, 0)
+        top, right, bottom, left = self.roi
+        return (int(top * height), int(right * width), int(bottom * height), int(left * width))
+
+    def _around(self, box, frame_shape):
+        height, width = frame_shape[:2]
+        top, right, bottom, left = box
+        pad_y = int((bottom - top) * self.region_margin)
+        pad_x = int((right - left) * self.region_margin)
+        return (max(0, top - pad_y), min(width, right + pad_x),
+                min(height, bottom + pad_y), max(0, left - pad_x))
+
+    def plan(self, frame_shape):
+        """
+        Returns (scale, regions) for this frame: regions is a list of
+        full-frame (top, right, bottom, left) boxes to scan, or None for
+        the whole frame.
+        """
+        self.counters['frames'] += 1
+        full_scan = (
+            not self.track_regions
+            or self._since_full_scan is None
+            or self._since_full_scan + 1 >= self.full_scan_interval
+        )
+        if full_scan:
+            self._since_full_scan = 0
+            self.counters['full_scans'] += 1
+            return self.scale, None if self.roi is None else [self._roi_box(frame_shape)]
+
+        self._since_full_scan += 1
+        self.counters['region_scans'] += 1
+        return self.scale, _merge_regions([self._around(box, frame_shape) for box in self._previous])
+
+    def observe(self, boxes, latency: float) -> None:
+        """Record this frame's faces and how long recognizing it took (seconds)."""
+        self._previous = list(boxes)
+        # Smooth over a few frames so one slow frame doesn't swing the scale
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if not self.target_fps:
+            return
+        budget = 1.0 / self.target_fps
+        previous_scale = self.scale
+        if self.latency > budget:
+            # Detection cost grows with pixel count, i.e. with scale squared
+            self.scale = max(self.min_scale, self.scale * max(0.7, (budget / self.latency) ** 0.5))
+        elif self.latency < 0.6 * budget:
+            self.scale = min(self.max_scale, self.scale * 1.1)
+        # Expect the new scale's cost now rather than waiting for the average to catch up
+        self.latency *= (self.scale / previous_scale) ** 2
+
+    def stats(self) -> dict:
+        return dict(
+            self.counters,
+            model=self.model,
+            scale=round(self.scale, 3),
+            latency_ms=round(self.latency * 1000, 1) if self.latency is not None else None,
+        )
@@ -0,0 +1,50 @@
+"""
+Enrollment photo checks. A blurry, tiny or crowded photo makes a poor
+template that then fails to match its owner, so photos are screened with
+cheap OpenCV measurements on the detected face before the (much more
+expensive) encoder runs.
+"""
+import numpy as np
+
+DEFAULT_MIN_FACE_SIZE = 80  # Pixels along the face box's shorter side
+DEFAULT_MIN_SHARPNESS = 50.0  # Variance of the Laplacian on the normalized face crop
+
+# Faces are resized to the encoder's input size before measuring
+# sharpness, so the threshold does not depend on the photo's resolution.
+FACE_CHIP_SIZE = 150
+
+
+def face_sharpness(image, location) -> float:
+    """
+    Variance of the Laplacian over one face (an RGB image and a
+    (top, right, bottom, left) box). Low values mean few edges: blur.
+    """
+    import cv2
+
+    top, right, bottom, left = location
+    face = image[max(0, top):bottom, max(0, left):right]
+    if face.size == 0:
+        return 0.0
+    gray = cv2.cvtColor(np.ascontiguousarray(face), cv2.COLOR_RGB2GRAY)
+    gray = cv2.resize(gray, (FACE_CHIP_SIZE, FACE_CHIP_SIZE), interpolation=cv2.INTER_AREA)
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+
+def check_enrollment_face(image, locations, min_face_size: int = DEFAULT_MIN_FACE_SIZE,
+                          min_sharpness: float = DEFAULT_MIN_SHARPNESS):
+    """
+    Decide whether a photo is fit to enroll, given the face boxes found in
+    it. Returns None if it is, otherwise the reason it was rejected.
+    """
+    if not locations:
+        return "No face found in image"
+    if len(locations) > 1:
+        return f"Found {len(locations)} faces, expected one"
+    top, right, bottom, left = locations[0]
+    size = min(bottom - top, right - left)
+    if size < min_face_size:
+        return f"Face too small ({size} px, need {min_face_size})"
+    sharpness = face_sharpness(image, locations[0])
+    if sharpness < min_sharpness:
+        return f"Image too blurry (sharpness {sharpness:.0f}, need {min_sharpness:.0f})"
+    return None
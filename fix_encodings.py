@@ -1,28 +1,109 @@
+import argparse
 import sqlite3
 import pickle
 import numpy as np
 
-def fix_encodings():
-    conn = sqlite3.connect('face_recognition.db')
+from database import (
+    DEFAULT_ENCODING_DTYPE, ENCODING_DTYPES, FaceDatabase, deserialize_encoding,
+    is_legacy_encoding, serialize_encoding
+)
+from gallery import EMBEDDING_DIM
+
+
+def validate_encoding(encoding):
+    """Raise ValueError unless this looks like a usable face encoding."""
+    values = np.asarray(encoding, dtype=np.float64)
+    if values.shape != (EMBEDDING_DIM,):
+        raise ValueError(f"Expected shape ({EMBEDDING_DIM},), got {values.shape}")
+    if not np.isfinite(values).all():
+        raise ValueError("Encoding contains NaN or infinite values")
+    return values
+
+
+def fix_encodings(db_path: str = 'face_recognition.db', batch_size: int = 1000,
+                  dtype_code: bytes = DEFAULT_ENCODING_DTYPE, delete_invalid: bool = True,
+                  dry_run: bool = False, vacuum: bool = False):
+    """
+    Validate every stored encoding and convert legacy pickle BLOBs to the
+    binary format, streaming through the table in batches of `batch_size`
+    rows (each batch is its own transaction, so the tool can be interrupted
+    and re-run). Rows that cannot be decoded are deleted unless
+    `delete_invalid` is False.
+    """
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA foreign_keys = ON")
     cursor = conn.cursor()
-    
-    cursor.execute('SELECT encoding_id, user_id, encoding FROM face_encodings')
-    rows = cursor.fetchall()
-    
-    for encoding_id, user_id, encoding_blob in rows:
-        try:
-            # Test if encoding is valid
-            encoding = pickle.loads(encoding_blob)
-            np.frombuffer(encoding, dtype=np.float64)
-            print(f"Encoding {encoding_id} for user {user_id} is valid")
-        except Exception as e:
-            print(f"Fixing invalid encoding {encoding_id} for user {user_id}")
-            cursor.execute('DELETE FROM face_encodings WHERE encoding_id = ?', (encoding_id,))
-    
-    conn.commit()
+    counts = {'valid': 0, 'converted': 0, 'invalid': 0}
+    last_id = 0
+
+    while True:
+        # Keyset pagination keeps memory flat no matter how big the table is
+        cursor.execute('''
+            SELECT encoding_id, user_id, encoding FROM face_encodings
+            WHERE encoding_id > ? ORDER BY encoding_id LIMIT ?
+        ''', (last_id, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        updates = []
+        invalid = []
+        for encoding_id, user_id, encoding_blob in rows:
+            try:
+                if is_legacy_encoding(encoding_blob):
+                    encoding = validate_encoding(pickle.loads(encoding_blob))
+                    updates.append((serialize_encoding(encoding, dtype_code), encoding_id))
+                    counts['converted'] += 1
+                else:
+                    validate_encoding(deserialize_encoding(encoding_blob))
+                    counts['valid'] += 1
+            except Exception as e:
+                print(f"Invalid encoding {encoding_id} for user {user_id}: {str(e)}")
+                invalid.append((encoding_id,))
+                counts['invalid'] += 1
+
+        if not dry_run:
+            cursor.executemany('UPDATE face_encodings SET encoding = ? WHERE encoding_id = ?', updates)
+            if delete_invalid:
+                cursor.executemany('DELETE FROM face_encodings WHERE encoding_id = ?', invalid)
+            conn.commit()
+        print(f"Processed encodings up to id {last_id}: {counts}")
+
+    if counts['invalid'] and delete_invalid and not dry_run:
+        # Deleted rows no longer count towards their users' templates
+        db = FaceDatabase(db_path)
+        db.rebuild_templates()
+        db.close()
+
+    if vacuum and not dry_run:
+        # Reclaim the space freed by the smaller rows
+        conn.execute('VACUUM')
+
     cursor.close()
     conn.close()
-    print("Database repair complete")
+    print("Database repair complete" + (" (dry run, nothing written)" if dry_run else ""))
+    return counts
+
 
 if __name__ == '__main__':
-    fix_encodings()
\ No newline at end of file
+    parser = argparse.ArgumentParser(
+        description="Validate stored face encodings and migrate pickled ones to the binary format")
+    parser.add_argument('--db', default='face_recognition.db')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--dtype', choices=[code.decode() for code in ENCODING_DTYPES],
+                        default=DEFAULT_ENCODING_DTYPE.decode(),
+                        help="f = float32 (default), d = float64")
+    parser.add_argument('--keep-invalid', action='store_true', help="Report invalid rows without deleting them")
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--vacuum', action='store_true', help="VACUUM afterwards to shrink the file")
+    args = parser.parse_args()
+
+    fix_encodings(
+        args.db,
+        batch_size=args.batch_size,
+        dtype_code=args.dtype.encode(),
+        delete_invalid=not args.keep_invalid,
+        dry_run=args.dry_run,
+        vacuum=args.vacuum
+    )
@@ -0,0 +1,476 @@
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from metrics import counter, gauge, histogram
+from snapshot import claim_export, export_snapshot, load_snapshot, read_snapshot_version, release_export
+
+# face_recognition produces 128-dimensional encodings.
+EMBEDDING_DIM = 128
+
+GALLERY_LOADS = counter('gallery_loads', "Full gallery loads", ['source'])
+GALLERY_LOAD_SECONDS = histogram('gallery_load_seconds', "Time to load the full gallery", ['source'])
+GALLERY_REFRESHES = counter('gallery_refreshes', "Gallery cache refreshes: hit = unchanged, delta = changes applied",
+                            ['result'])
+GALLERY_SIZE = gauge('gallery_size', "Rows (encodings or per-user templates) in the in-memory gallery")
+GALLERY_CACHE_AGE = gauge('gallery_cache_age_seconds', "Seconds since the gallery cache last changed")
+
+
+class FaceGallery:
+    """
+    Holds every known face encoding in one contiguous float32 matrix,
+    with parallel user_id/name arrays and precomputed squared norms.
+
+    A gallery wrapping a memory-mapped snapshot never copies the mapped
+    matrix. Its first change turns it into an overlay: the snapshot rows
+    stay shared and read-only as the base, added rows go to a small
+    private matrix, and `_rows` maps every row to its place in either
+    one, so removed base rows are simply left out. The per-row arrays
+    (norms and ids, 20 bytes a row against 512 for the encoding) are
+    copied privately as before.
+    """
+    def __init__(self, capacity: int = 1024, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+        self.size = 0
+        # Preallocate storage; grows geometrically when full.
+        self._matrix = np.empty((max(capacity, 1), dim), dtype=np.float32)
+        self._sq_norms = np.empty(max(capacity, 1), dtype=np.float32)
+        self._user_ids = np.empty(max(capacity, 1), dtype=np.int64)
+        self._encoding_ids = np.empty(max(capacity, 1), dtype=np.int64)
+        self._rows_by_encoding = {}
+        self.names = []
+        # Overlay state, see above: None/None/0 unless built on a snapshot
+        self._base = None
+        self._rows = None
+        self._tail_size = 0
+
+    @classmethod
+    def from_database(cls, db, templates: bool = False) -> 'FaceGallery':
+        """
+        Build a gallery straight from FaceDatabase.get_encoding_matrix(),
+        or with `templates` from get_template_matrix() (one row per user,
+        keyed by template_id).
+        """
+        if templates:
+            encoding_ids, user_ids, names, matrix = db.get_template_matrix()
+        else:
+            encoding_ids, user_ids, names, matrix = db.get_encoding_matrix()
+        gallery = cls(capacity=len(names))
+        if names:
+            gallery.extend(matrix, user_ids, names, encoding_ids)
+        return gallery
+
+    @classmethod
+    def from_arrays(cls, matrix, sq_norms, user_ids, encoding_ids, names) -> 'FaceGallery':
+        """
+        Wrap existing arrays (e.g. read-only views of a memory-mapped
+        snapshot) without copying them. A read-only matrix is never
+        copied: the first write starts an overlay on top of it.
+        """
+        gallery = cls.__new__(cls)
+        gallery.dim = matrix.shape[1]
+        gallery.size = matrix.shape[0]
+        gallery._matrix = matrix
+        gallery._sq_norms = sq_norms
+        gallery._user_ids = user_ids
+        gallery._encoding_ids = encoding_ids
+        gallery.names = list(names)
+        gallery._rows_by_encoding = {
+            int(encoding_id): row for row, encoding_id in enumerate(encoding_ids) if encoding_id >= 0
+        }
+        gallery._base = None
+        gallery._rows = None
+        gallery._tail_size = 0
+        return gallery
+
+    @classmethod
+    def from_snapshot(cls, path: str, source: str = None):
+        """
+        Memory-map a gallery snapshot file. Returns (gallery, version).
+        Raises ValueError if `source` is given and does not match the
+        snapshot's.
+        """
+        version, matrix, sq_norms, user_ids, encoding_ids, names = load_snapshot(path, source)
+        return cls.from_arrays(matrix, sq_norms, user_ids, encoding_ids, names), version
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def matrix(self):
+        """Read-only array of the populated rows (a copy for an overlay, see vectors())."""
+        view = self.vectors()
+        view.flags.writeable = False
+        return view
+
+    @property
+    def shares_snapshot(self) -> bool:
+        """Whether the encodings are (still) read from a memory-mapped snapshot."""
+        return self._base is not None or not self._matrix.flags.writeable
+
+    def vectors(self, rows=None):
+        """
+        Encodings of the given rows (an index array or slice; every row by
+        default). A view of the storage, except for an overlay, where the
+        rows are gathered from the base and the private part into a copy.
+        """
+        if rows is None:
+            rows = slice(0, self.size)
+        if self._rows is None:
+            return self._matrix[:self.size][rows]
+        physical = self._rows[:self.size][rows]
+        base_size = len(self._base)
+        in_base = physical < base_size
+        vectors = np.empty((len(physical), self.dim), dtype=np.float32)
+        vectors[in_base] = self._base[physical[in_base]]
+        vectors[~in_base] = self._matrix[physical[~in_base] - base_size]
+        return vectors
+
+    @property
+    def user_ids(self):
+        return self._user_ids[:self.size]
+
+    @property
+    def encoding_ids(self):
+        return self._encoding_ids[:self.size]
+
+    @property
+    def sq_norms(self):
+        return self._sq_norms[:self.size]
+
+    def __contains__(self, encoding_id):
+        return encoding_id in self._rows_by_encoding
+
+    def _row_arrays(self):
+        """Names of the arrays holding one entry per row, in row order."""
+        if self._rows is None:
+            return ('_matrix', '_sq_norms', '_user_ids', '_encoding_ids')
+        return ('_rows', '_sq_norms', '_user_ids', '_encoding_ids')
+
+    def _grow(self, attrs, used: int, needed: int, copy: bool = False):
+        """Reallocate `attrs` (keeping their first `used` entries) if they hold fewer than `needed`."""
+        capacity = max(getattr(self, attrs[0]).shape[0], 1)
+        if needed <= capacity and not copy:
+            return
+        while capacity < needed:
+            capacity *= 2
+        for attr in attrs:
+            old = getattr(self, attr)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:used] = old[:used]
+            setattr(self, attr, new)
+
+    def _reserve(self, extra: int):
+        """Make room for `extra` more rows."""
+        if self._rows is not None:
+            self._grow(('_matrix',), self._tail_size, self._tail_size + extra)
+        self._grow(self._row_arrays(), self.size, self.size + extra)
+
+    def _ensure_writable(self):
+        """
+        Before the first change to a gallery wrapping a read-only (mapped)
+        matrix: keep that matrix as the shared base and start an overlay.
+        """
+        if self._rows is not None or self._matrix.flags.writeable:
+            return
+        self._base = self._matrix
+        self._matrix = np.empty((16, self.dim), dtype=np.float32)
+        self._tail_size = 0
+        self._rows = np.arange(self.size, dtype=np.int64)
+        # Private, writable copies of the (small) per-row arrays
+        self._grow(self._row_arrays(), self.size, self.size, copy=True)
+
+    def _compact_tail(self):
+        """Reclaim private rows that have since been removed, once they are the majority."""
+        base_size = len(self._base)
+        rows = self._rows[:self.size]
+        in_tail = rows >= base_size
+        live = rows[in_tail] - base_size
+        if len(live) * 2 >= self._tail_size:
+            return
+        # Rows are kept in physical order, so compacting preserves it
+        self._matrix[:len(live)] = self._matrix[live]
+        rows[in_tail] = base_size + np.arange(len(live))
+        self._tail_size = len(live)
+
+    def extend(self, encodings, user_ids, names, encoding_ids=None) -> None:
+        """
+        Append several encodings at once. `encoding_ids` (database ids) are
+        optional but required for later remove() calls.
+        """
+        block = np.asarray(encodings, dtype=np.float32).reshape(-1, self.dim)
+        count = block.shape[0]
+        if encoding_ids is None:
+            encoding_ids = [-1] * count
+        if not count == len(user_ids) == len(names) == len(encoding_ids):
+            raise ValueError("encodings, user_ids, names and encoding_ids must have the same length")
+        self._ensure_writable()
+        self._reserve(count)
+        rows = slice(self.size, self.size + count)
+        if self._rows is None:
+            self._matrix[rows] = block
+        else:
+            tail = self._tail_size
+            self._matrix[tail:tail + count] = block
+            self._rows[rows] = len(self._base) + np.arange(tail, tail + count)
+            self._tail_size += count
+        self._sq_norms[rows] = np.einsum('ij,ij->i', block, block)
+        self._user_ids[rows] = user_ids
+        self._encoding_ids[rows] = encoding_ids
+        for row, encoding_id in enumerate(encoding_ids, start=self.size):
+            if encoding_id >= 0:
+                self._rows_by_encoding[encoding_id] = row
+        self.names.extend(names)
+        self.size += count
+
+    def remove(self, encoding_ids):
+        """
+        Drop the rows holding the given encoding ids, compacting the matrix.
+        Returns a boolean mask over the previous rows marking those kept,
+        or None if nothing was removed.
+        """
+        rows = [self._rows_by_encoding[e] for e in encoding_ids if e in self._rows_by_encoding]
+        if not rows:
+            return None
+        self._ensure_writable()
+        keep = np.ones(self.size, dtype=bool)
+        keep[rows] = False
+        kept = np.flatnonzero(keep)
+        # An overlay only drops the rows' entries: the base is never rewritten
+        for attr in self._row_arrays():
+            values = getattr(self, attr)
+            values[:len(kept)] = values[kept]
+        self.names = [self.names[i] for i in kept]
+        self.size = len(kept)
+        if self._rows is not None:
+            self._compact_tail()
+        self._rows_by_encoding = {
+            int(encoding_id): row
+            for row, encoding_id in enumerate(self._encoding_ids[:self.size])
+            if encoding_id >= 0
+        }
+        return keep
+
+    def distances(self, encodings, rows=None):
+        """
+        Euclidean distance from each query encoding to every gallery row,
+        or only to the given row indices.
+        Returns a (num_queries, num_rows) float32 array.
+        """
+        queries = np.asarray(encodings, dtype=np.float32).reshape(-1, self.dim)
+        sq_norms = self._sq_norms[:self.size] if rows is None else self._sq_norms[:self.size][rows]
+        if sq_norms.shape[0] == 0:
+            return np.empty((queries.shape[0], 0), dtype=np.float32)
+        query_sq_norms = np.einsum('ij,ij->i', queries, queries)
+        # |q - g|^2 = |q|^2 + |g|^2 - 2 q.g, computed as one matrix product.
+        if rows is None and self._rows is not None:
+            # Overlay: multiply against the base and private rows where they
+            # are, then pick out the live ones, instead of gathering a copy
+            squared = np.concatenate(
+                [queries @ self._base.T, queries @ self._matrix[:self._tail_size].T], axis=1
+            )[:, self._rows[:self.size]]
+        else:
+            squared = queries @ self.vectors(rows).T
+        squared *= -2
+        squared += query_sq_norms[:, None]
+        squared += sq_norms[None, :]
+        np.maximum(squared, 0, out=squared)
+        return np.sqrt(squared, out=squared)
+
+    def identity(self, index: int):
+        """Return (user_id, name) for a gallery row."""
+        return int(self._user_ids[index]), self.names[index]
+
+
+def gallery_source(db, templates: bool = False) -> str:
+    """
+    Which database and change log gallery versions come from, as stored
+    in snapshots: one written for another database (e.g. before a reset,
+    when user_ids start again at 1) or the other gallery kind is never
+    loaded.
+    """
+    return f"{db.get_database_id()}/{'templates' if templates else 'encodings'}"
+
+
+class GalleryCache:
+    """
+    Keeps a FaceGallery and the matcher built on it in sync with the
+    database by replaying the gallery_changes log, so new registrations
+    show up on the next refresh() without a full reload.
+
+    With a `snapshot_path`, startup memory-maps the snapshot file (shared
+    by every process) and only replays changes newer than it; whenever
+    this process has seen newer changes it rewrites the snapshot in the
+    background, unless another process already is. Changes after startup
+    never copy the mapped matrix: added rows live in a small private
+    overlay (see FaceGallery) until the next restart.
+
+    With `templates`, the gallery holds one template per user (see
+    FaceDatabase.get_template_matrix) and follows the template_changes
+    log instead, so matching costs one row per person however many
+    encodings they have.
+
+    Deltas are applied to the matcher in place; `matcher_is_stale`, if
+    given, is asked after each one whether the matcher should be rebuilt
+    with matcher_factory instead (see matcher.matcher_is_stale).
+    """
+    def __init__(self, db, matcher_factory=None, snapshot_path: str = None, templates: bool = False,
+                 matcher_is_stale=None):
+        self.db = db
+        self.matcher_factory = matcher_factory
+        self.matcher_is_stale = matcher_is_stale
+        self.snapshot_path = snapshot_path
+        self.templates = templates
+        self.version = None
+        self.gallery = None
+        self.matcher = None
+        self._lock = threading.Lock()
+        self._exporting = False
+        self.updated_at = None
+        GALLERY_SIZE.set_function(lambda: len(self.gallery) if self.gallery is not None else 0)
+        GALLERY_CACHE_AGE.set_function(
+            lambda: time.time() - self.updated_at if self.updated_at is not None else 0)
+
+    def _get_version(self) -> int:
+        if self.templates:
+            return self.db.get_template_version()
+        return self.db.get_gallery_version()
+
+    def _get_changes(self, since_version: int):
+        if self.templates:
+            return self.db.get_template_changes(since_version)
+        return self.db.get_gallery_changes(since_version)
+
+    def source_id(self) -> str:
+        return gallery_source(self.db, self.templates)
+
+    def reload(self):
+        """Load every encoding from scratch and rebuild the matcher."""
+        with self._lock:
+            self._reload()
+
+    def _reload(self):
+        gallery = None
+        start = time.perf_counter()
+        source = 'snapshot'
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            try:
+                gallery, version = FaceGallery.from_snapshot(self.snapshot_path, self.source_id())
+                if version > self._get_version():
+                    raise ValueError(f"snapshot version {version} is ahead of the database")
+            except (OSError, ValueError) as e:
+                gallery = None
+                logging.warning(f"Ignoring gallery snapshot: {str(e)}")
+        if gallery is None:
+            source = 'database'
+            # Read the version first: changes racing with the load are replayed
+            # by the next refresh(), and replaying an add twice is a no-op.
+            version = self._get_version()
+            gallery = FaceGallery.from_database(self.db, self.templates)
+        GALLERY_LOADS.labels(source=source).inc()
+        GALLERY_LOAD_SECONDS.labels(source=source).observe(time.perf_counter() - start)
+        self.updated_at = time.time()
+        self.gallery = gallery
+        self.version = version
+        self.matcher = None
+        # Catch up with anything newer than the snapshot before building the matcher
+        if self._get_version() != version:
+            self._apply_changes(self._get_changes(version))
+        self.matcher = self.matcher_factory(gallery) if self.matcher_factory else None
+        logging.info(
+            f"Loaded {len(gallery)} known {'users' if self.templates else 'faces'} (gallery version {self.version})")
+        self._maybe_export_snapshot()
+
+    def refresh(self):
+        """
+        Apply any changes made since the last refresh. Returns the matcher
+        (or the gallery when no matcher factory was given).
+        """
+        with self._lock:
+            if self.gallery is None:
+                self._reload()
+            elif self._get_version() != self.version:
+                self._apply_changes(self._get_changes(self.version))
+                if self.matcher is not None and self.matcher_is_stale and self.matcher_is_stale(self.matcher):
+                    logging.info(f"Rebuilding matcher for {len(self.gallery)} gallery rows")
+                    self.matcher = self.matcher_factory(self.gallery)
+                self._maybe_export_snapshot()
+                GALLERY_REFRESHES.labels(result='delta').inc()
+                self.updated_at = time.time()
+            else:
+                GALLERY_REFRESHES.labels(result='hit').inc()
+            return self.matcher if self.matcher_factory else self.gallery
+
+    def _maybe_export_snapshot(self):
+        """
+        Rewrite the snapshot in the background if it is older than our
+        gallery or belongs to another source. Only one process at a time
+        does so (see claim_export); the others skip it rather than
+        writing the same file again.
+        """
+        if not self.snapshot_path or self._exporting:
+            return
+        source = self.source_id()
+        on_disk = read_snapshot_version(self.snapshot_path)
+        if on_disk is not None and on_disk[1] == source and on_disk[0] >= self.version:
+            return
+        if not claim_export(self.snapshot_path):
+            return
+        # Another process may have just finished the same export
+        on_disk = read_snapshot_version(self.snapshot_path)
+        if on_disk is not None and on_disk[1] == source and on_disk[0] >= self.version:
+            release_export(self.snapshot_path)
+            return
+        # Copy under the cache lock so the export sees one consistent version
+        # (matrix is already a fresh copy when the gallery is an overlay)
+        matrix = self.gallery.matrix
+        snapshot = FaceGallery.from_arrays(
+            matrix if matrix.flags.owndata else matrix.copy(), self.gallery.sq_norms.copy(),
+            self.gallery.user_ids.copy(), self.gallery.encoding_ids.copy(), self.gallery.names)
+        self._exporting = True
+        threading.Thread(
+            target=self._export_snapshot, args=(snapshot, self.version, source),
+            name='gallery-snapshot', daemon=True
+        ).start()
+
+    def _export_snapshot(self, gallery, version, source):
+        try:
+            export_snapshot(gallery, self.snapshot_path, version, source)
+        except OSError as e:
+            # e.g. Windows refuses to replace a file another process has mapped
+            logging.warning(f"Could not write gallery snapshot: {str(e)}")
+        finally:
+            release_export(self.snapshot_path)
+            self._exporting = False
+
+    def _apply_changes(self, changes):
+        removed = {c['encoding_id'] for c in changes if c['op'] == 'remove'}
+        # Encoding (and template) ids are never reused, so an add followed by a remove nets out.
+        added = [
+            c for c in changes
+            if c['op'] == 'add' and c['encoding'] is not None
+            and c['encoding_id'] not in removed and c['encoding_id'] not in self.gallery
+        ]
+
+        removed_count = 0
+        keep = self.gallery.remove(removed)
+        if keep is not None:
+            removed_count = int(np.count_nonzero(~keep))
+            if self.matcher is not None:
+                self.matcher.rows_removed(keep)
+        if added:
+            start = len(self.gallery)
+            self.gallery.extend(
+                [c['encoding'] for c in added],
+                [c['user_id'] for c in added],
+                [c['name'] for c in added],
+                [c['encoding_id'] for c in added]
+            )
+            if self.matcher is not None:
+                self.matcher.rows_added(start)
+
+        self.version = changes[-1]['change_id'] if changes else self.version
+        logging.info(f"Gallery updated: +{len(added)} -{removed_count} (version {self.version})")
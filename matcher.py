@@ -0,0 +1,267 @@
+import logging
+import os
+import zlib
+
+import numpy as np
+
+# Below this many gallery rows brute force is already fast and exact.
+DEFAULT_ANN_MIN_GALLERY_SIZE = 10000
+
+# Retrain an IVF index once the gallery has grown or shrunk by this factor
+# since its centroids were trained.
+IVF_RETRAIN_FACTOR = 2.0
+
+
+def _empty_results(num_queries: int, k: int):
+    return (np.full((num_queries, k), -1, dtype=np.int64),
+            np.full((num_queries, k), np.inf, dtype=np.float32))
+
+
+def _top_k(distances, rows, k: int, threshold: float = None):
+    """
+    Select the k smallest distances (and their gallery rows) from a 1-D array,
+    dropping anything further away than `threshold`.
+    """
+    if len(distances) > k:
+        order = np.argpartition(distances, k - 1)[:k]
+        order = order[np.argsort(distances[order])]
+    else:
+        order = np.argsort(distances)
+    best_rows, best_distances = rows[order], distances[order]
+    if threshold is not None:
+        keep = best_distances <= threshold
+        best_rows, best_distances = best_rows[keep], best_distances[keep]
+    return best_rows, best_distances
+
+
+def gallery_fingerprint(gallery) -> int:
+    """Checksum of the gallery contents, used to detect stale index files."""
+    checksum = zlib.crc32(np.ascontiguousarray(gallery.matrix).tobytes())
+    return zlib.crc32(np.ascontiguousarray(gallery.user_ids).tobytes(), checksum)
+
+
+class ExactMatcher:
+    """
+    Brute-force search over every gallery row.
+    """
+    def __init__(self, gallery):
+        self.gallery = gallery
+
+    def search(self, encodings, k: int = 1, threshold: float = None):
+        """
+        Return (rows, distances), each shaped (num_queries, k), for the k
+        nearest gallery rows of every query. Slots with no match within
+        `threshold` are filled with -1 / inf.
+        """
+        distances = self.gallery.distances(encodings)
+        rows, result_distances = _empty_results(distances.shape[0], k)
+        all_rows = np.arange(distances.shape[1])
+        for i, query_distances in enumerate(distances):
+            best_rows, best_distances = _top_k(query_distances, all_rows, k, threshold)
+            rows[i, :len(best_rows)] = best_rows
+            result_distances[i, :len(best_distances)] = best_distances
+        return rows, result_distances
+
+    def rows_added(self, start: int) -> None:
+        """Gallery rows from `start` onwards were appended; nothing to index."""
+
+    def rows_removed(self, keep) -> None:
+        """Gallery rows not set in `keep` were removed; nothing to index."""
+
+
+class IVFMatcher:
+    """
+    Inverted-file index: gallery rows are partitioned with k-means and a
+    query only scans the `n_probe` partitions with the closest centroids.
+    """
+    def __init__(self, gallery, centroids, assignments, n_probe: int = 16):
+        self.gallery = gallery
+        # Gallery size the centroids were trained for; rows_added/rows_removed keep them.
+        self.trained_size = len(gallery)
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.centroid_sq_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        # Partition of every gallery row.
+        self.assignments = np.asarray(assignments, dtype=np.int64)
+        self.n_probe = n_probe
+        self._rebuild_lists()
+
+    def _rebuild_lists(self):
+        # Rows of list i are list_rows[list_offsets[i]:list_offsets[i + 1]].
+        self.list_rows = np.argsort(self.assignments, kind='stable')
+        self.list_offsets = np.zeros(len(self.centroids) + 1, dtype=np.int64)
+        counts = np.bincount(self.assignments, minlength=len(self.centroids))
+        np.cumsum(counts, out=self.list_offsets[1:])
+
+    def rows_added(self, start: int) -> None:
+        """Assign gallery rows appended from `start` onwards to their partitions."""
+        new_rows = self.gallery.vectors(slice(start, None))
+        self.assignments = np.concatenate([self.assignments[:start], self._assign(new_rows, self.centroids)])
+        self._rebuild_lists()
+
+    def rows_removed(self, keep) -> None:
+        """Drop partition entries for gallery rows not set in the `keep` mask."""
+        self.assignments = self.assignments[keep]
+        self._rebuild_lists()
+
+    @classmethod
+    def build(cls, gallery, n_lists: int = None, n_probe: int = 16,
+              iterations: int = 10, sample_size: int = 50000, seed: int = 0) -> 'IVFMatcher':
+        """
+        Train k-means centroids on (a sample of) the gallery and bucket every row.
+        """
+        size = len(gallery)
+        if size == 0:
+            raise ValueError("Cannot build an index for an empty gallery")
+        if n_lists is None:
+            # Common IVF rule of thumb: about sqrt(N) partitions.
+            n_lists = max(1, int(np.sqrt(size)))
+        n_lists = min(n_lists, size)
+
+        rng = np.random.default_rng(seed)
+        matrix = gallery.matrix
+        sample = matrix
+        if size > sample_size:
+            sample = matrix[rng.choice(size, sample_size, replace=False)]
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+
+        for _ in range(iterations):
+            assignments = cls._assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            counts = np.bincount(assignments, minlength=n_lists)
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+            # Re-seed empty partitions with random sample points.
+            empty = np.flatnonzero(~filled)
+            if len(empty):
+                centroids[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+
+        assignments = cls._assign(matrix, centroids)
+        logging.info(f"Built IVF index with {n_lists} lists over {size} encodings")
+        return cls(gallery, centroids, assignments, n_probe=n_probe)
+
+    @staticmethod
+    def _assign(points, centroids, chunk_size: int = 8192):
+        """Index of the nearest centroid for every point."""
+        centroid_sq_norms = np.einsum('ij,ij->i', centroids, centroids)
+        assignments = np.empty(len(points), dtype=np.int64)
+        for start in range(0, len(points), chunk_size):
+            chunk = points[start:start + chunk_size]
+            # argmin |p - c|^2 == argmin |c|^2 - 2 p.c
+            scores = centroid_sq_norms[None, :] - 2 * (chunk @ centroids.T)
+            assignments[start:start + chunk_size] = np.argmin(scores, axis=1)
+        return assignments
+
+    def search(self, encodings, k: int = 1, threshold: float = None):
+        """
+        Same contract as ExactMatcher.search, scanning only the closest partitions.
+        """
+        queries = np.asarray(encodings, dtype=np.float32).reshape(-1, self.gallery.dim)
+        rows, result_distances = _empty_results(queries.shape[0], k)
+        n_probe = min(self.n_probe, len(self.centroids))
+        scores = self.centroid_sq_norms[None, :] - 2 * (queries @ self.centroids.T)
+        probes = np.argpartition(scores, n_probe - 1, axis=1)[:, :n_probe]
+
+        for i, query in enumerate(queries):
+            candidates = np.concatenate([
+                self.list_rows[self.list_offsets[j]:self.list_offsets[j + 1]]
+                for j in probes[i]
+            ])
+            if len(candidates) == 0:
+                continue
+            distances = self.gallery.distances(query, rows=candidates)[0]
+            best_rows, best_distances = _top_k(distances, candidates, k, threshold)
+            rows[i, :len(best_rows)] = best_rows
+            result_distances[i, :len(best_distances)] = best_distances
+        return rows, result_distances
+
+    def save(self, path: str) -> None:
+        """Persist the index next to a fingerprint of the gallery it was built from."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                centroids=self.centroids,
+                assignments=self.assignments,
+                n_probe=self.n_probe,
+                fingerprint=gallery_fingerprint(self.gallery),
+                size=len(self.gallery)
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, gallery) -> 'IVFMatcher':
+        """
+        Load an index saved by save(). Raises ValueError when it was built
+        from a different gallery.
+        """
+        with np.load(path) as data:
+            if int(data['size']) != len(gallery) or int(data['fingerprint']) != gallery_fingerprint(gallery):
+                raise ValueError(f"Index {path} does not match the current gallery")
+            return cls(
+                gallery,
+                data['centroids'],
+                data['assignments'],
+                n_probe=int(data['n_probe'])
+            )
+
+
+def build_matcher(gallery, min_ann_size: int = DEFAULT_ANN_MIN_GALLERY_SIZE,
+                  index_path: str = None, **ivf_options):
+    """
+    Pick a matcher for the gallery: exact search for small galleries,
+    otherwise an IVF index (reused from `index_path` when it is still valid).
+    """
+    if len(gallery) < min_ann_size:
+        return ExactMatcher(gallery)
+
+    if index_path and os.path.exists(index_path):
+        try:
+            return IVFMatcher.load(index_path, gallery)
+        except (ValueError, OSError, KeyError) as e:
+            logging.info(f"Rebuilding IVF index: {str(e)}")
+
+    matcher = IVFMatcher.build(gallery, **ivf_options)
+    if index_path:
+        try:
+            matcher.save(index_path)
+        except OSError as e:
+            logging.warning(f"Could not save IVF index: {str(e)}")
+    return matcher
+
+
+def matcher_is_stale(matcher, min_ann_size: int = DEFAULT_ANN_MIN_GALLERY_SIZE,
+                     retrain_factor: float = IVF_RETRAIN_FACTOR) -> bool:
+    """
+    Whether a matcher kept up to date with rows_added/rows_removed should
+    be rebuilt: its gallery has crossed `min_ann_size` (so build_matcher
+    would now pick the other kind), or an IVF index has drifted more than
+    `retrain_factor` from the size its centroids were trained on.
+    """
+    size = len(matcher.gallery)
+    if isinstance(matcher, ExactMatcher):
+        return size >= min_ann_size
+    if size < min_ann_size:
+        return True
+    return not matcher.trained_size / retrain_factor <= size <= matcher.trained_size * retrain_factor
+
+
+if __name__ == '__main__':
+    import argparse
+    from database import FaceDatabase
+    from gallery import FaceGallery
+
+    parser = argparse.ArgumentParser(description="Build the IVF face index from the database")
+    parser.add_argument('--db', default='face_recognition.db')
+    parser.add_argument('--out', default='face_index.npz')
+    parser.add_argument('--lists', type=int, default=None)
+    parser.add_argument('--probe', type=int, default=16)
+    parser.add_argument('--templates', action=argparse.BooleanOptionalAction, default=True,
+                        help="Index one template per user, as served with GALLERY_TEMPLATES (the default)")
+    args = parser.parse_args()
+
+    db = FaceDatabase(args.db)
+    gallery = FaceGallery.from_database(db, templates=args.templates)
+    db.close()
+    IVFMatcher.build(gallery, n_lists=args.lists, n_probe=args.probe).save(args.out)
+    print(f"Saved index for {len(gallery)} {'templates' if args.templates else 'encodings'} to {args.out}")
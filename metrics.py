@@ -0,0 +1,341 @@
+"""
+In-process counters, gauges and histograms with Prometheus text output.
+
+Metrics are cheap enough for the per-frame hot path: an observation is a
+bisect plus a locked add. Labelled metrics create one child per label
+combination on first use.
+
+    FRAMES = counter('frames', "Frames captured", ['camera'])
+    FRAMES.labels(camera='main').inc()
+    with STAGE_SECONDS.labels(stage='detect').time():
+        ...
+"""
+import bisect
+import collections
+import functools
+import inspect
+import os
+import sys
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+START_TIME = time.time()
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + list(extra or [])
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _milliseconds(seconds):
+    # Past the last bucket there is no upper bound to report
+    return None if seconds == float('inf') else round(seconds * 1000, 2)
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name: str, documentation: str, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _default(self):
+        # Unlabelled metrics are their own single child
+        return self.labels()
+
+    def collect(self):
+        """Yield (suffix, label_values, extra_labels, value) samples."""
+        for key, child in list(self._children.items()):
+            for suffix, extra, value in child.samples():
+                yield suffix, key, extra, value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for suffix, key, extra, value in self.collect():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.label_names, key, extra)} {_format_value(value)}")
+        return '\n'.join(lines)
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        yield '_total', None, self.value
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+    _new_child = staticmethod(_CounterChild)
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Read the value from `function()` at collection time."""
+        self.function = function
+
+    def samples(self):
+        yield '', None, self.function() if self.function is not None else self.value
+
+
+class Gauge(_Metric):
+    type_name = 'gauge'
+    _new_child = staticmethod(_GaugeChild)
+
+    def set(self, value):
+        self._default().set(value)
+
+    def set_function(self, function):
+        self._default().set_function(function)
+
+
+class _Timer:
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.child.observe(time.perf_counter() - self.start)
+        return False
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def quantile(self, q: float):
+        """Approximate quantile: the upper bound of the bucket it falls in."""
+        if not self.count:
+            return None
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return float('inf')
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            yield '_bucket', [('le', _format_value(bound))], cumulative
+        yield '_sum', None, self.sum
+        yield '_count', None, self.count
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, label_names)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                # Module reloads register the same metric again
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def render(self) -> str:
+        """Everything in the Prometheus text exposition format."""
+        return '\n'.join(metric.render() for metric in list(self._metrics.values())) + '\n'
+
+    def summary(self) -> dict:
+        """
+        Compact view for /health: counters and gauges by value, histograms
+        as count, mean and approximate p50/p99 (in milliseconds for
+        *_seconds histograms).
+        """
+        summary = {}
+        for metric in list(self._metrics.values()):
+            for key, child in list(metric._children.items()):
+                name = metric.name + ''.join(f"[{value}]" for value in key)
+                if isinstance(child, _HistogramChild):
+                    if not child.count:
+                        continue
+                    if metric.name.endswith('_seconds'):
+                        summary[name] = {
+                            'count': child.count,
+                            'mean_ms': _milliseconds(child.sum / child.count),
+                            'p50_ms': _milliseconds(child.quantile(0.5)),
+                            'p99_ms': _milliseconds(child.quantile(0.99)),
+                        }
+                    else:
+                        summary[name] = {
+                            'count': child.count,
+                            'mean': round(child.sum / child.count, 2),
+                            'p50': child.quantile(0.5),
+                            'p99': child.quantile(0.99),
+                        }
+                else:
+                    (_, _, value), = child.samples()
+                    summary[name] = value
+        return summary
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, label_names=()):
+    return REGISTRY.register(Counter(name, documentation, label_names))
+
+
+def gauge(name, documentation, label_names=()):
+    return REGISTRY.register(Gauge(name, documentation, label_names))
+
+
+def histogram(name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, label_names, buckets))
+
+
+def instrument_methods(cls, metric, exclude=()):
+    """
+    Time every public method of `cls` into histogram `metric`, labelled
+    by method name. Generator methods are left alone (their work happens
+    after the call returns).
+    """
+    for name, function in list(vars(cls).items()):
+        if (name.startswith('_') or name in exclude or not inspect.isfunction(function)
+                or inspect.isgeneratorfunction(function)):
+            continue
+        child = metric.labels(method=name)
+
+        def timed(function=function, child=child):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    child.observe(time.perf_counter() - start)
+            return wrapper
+        setattr(cls, name, timed())
+    return cls
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler for a running process: a background thread
+    samples every thread's stack each `interval` seconds and counts
+    collapsed stacks ("a;b;c 42", the flame graph input format). Costs
+    nothing while stopped.
+    """
+    def __init__(self, interval: float = 0.005, max_depth: int = 40):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.started_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self.stacks.clear()
+        self.samples = 0
+        self.started_at = time.time()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self, limit: int = None) -> str:
+        """Most frequent stacks first, in collapsed-stack format."""
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common(limit)) + '\n'
@@ -0,0 +1,442 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+from metrics import counter, histogram
+
+STAGE_SECONDS = histogram('pipeline_stage_seconds', "Time spent per frame in each pipeline stage",
+                          ['camera', 'stage'])
+FRAMES = counter('pipeline_frames', "Frames completed by each pipeline stage", ['camera', 'stage'])
+DROPPED_FRAMES = counter('pipeline_dropped_frames', "Frames discarded because the next stage was behind",
+                         ['camera', 'stage'])
+FACES_PER_FRAME = histogram('pipeline_faces_per_frame', "Faces found per recognized frame",
+                            ['camera'], buckets=(0, 1, 2, 3, 5, 8, 13, 21))
+
+
+class LatestSlot:
+    """
+    Single-item mailbox that always holds the newest value.
+    Overwriting a value nobody consumed counts as a drop.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._item = None
+        self._consumed = True
+        self.seq = 0
+        self.drops = 0
+
+    def put(self, item) -> bool:
+        """Store `item`; returns True if it replaced one nobody had read."""
+        with self._condition:
+            dropped = not self._consumed
+            if dropped:
+                self.drops += 1
+            self._item = item
+            self._consumed = False
+            self.seq += 1
+            self._condition.notify_all()
+            return dropped
+
+    def get(self, after_seq: int = 0, timeout: float = None):
+        """
+        Wait for an item newer than `after_seq`.
+        Returns (seq, item), or (after_seq, None) on timeout.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.seq > after_seq, timeout):
+                return after_seq, None
+            self._consumed = True
+            return self.seq, self._item
+
+    def peek(self):
+        """Return the newest item without waiting or marking it consumed."""
+        with self._condition:
+            return self._item
+
+    @property
+    def depth(self) -> int:
+        return 0 if self._consumed else 1
+
+
+class RecognitionHistory:
+    """
+    Ring buffer of the most recent recognition results. Each result is a dict
+    with 'frame_id', 'timestamp' and 'faces' (the recognize callback's output:
+    dicts with 'box', 'encoding', 'user_id', 'name', 'distance', 'confidence';
+    user_id is None for faces that matched nobody).
+    """
+    def __init__(self, size: int = 30):
+        self._results = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def append(self, result) -> None:
+        with self._lock:
+            self._results.append(result)
+
+    def latest(self, max_age: float = None):
+        """Newest result, or None if there is none younger than `max_age` seconds."""
+        with self._lock:
+            if not self._results:
+                return None
+            result = self._results[-1]
+        if max_age is not None and time.time() - result['timestamp'] > max_age:
+            return None
+        return result
+
+    def recent(self, count: int):
+        """Up to `count` newest results, oldest first."""
+        with self._lock:
+            return list(self._results)[-count:]
+
+    def consensus(self, min_frames: int, window: int):
+        """
+        Users matched in at least `min_frames` of the last `window` results.
+        Returns {user_id: (name, best_distance)}.
+        """
+        seen = {}
+        for result in self.recent(window):
+            # Count each user once per frame
+            in_frame = {}
+            for face in result['faces']:
+                if face['user_id'] is None:
+                    continue
+                best = in_frame.get(face['user_id'])
+                if best is None or face['distance'] < best[1]:
+                    in_frame[face['user_id']] = (face['name'], face['distance'])
+            for user_id, (name, distance) in in_frame.items():
+                count, best_distance, _ = seen.get(user_id, (0, distance, name))
+                seen[user_id] = (count + 1, min(best_distance, distance), name)
+        return {
+            user_id: (name, best_distance)
+            for user_id, (count, best_distance, name) in seen.items()
+            if count >= min_frames
+        }
+
+
+def _redact_source(source) -> str:
+    """A source as text without any user:password@ it carries."""
+    text = str(source)
+    scheme, separator, rest = text.partition('://')
+    if separator and '@' in rest.split('/', 1)[0]:
+        return f"{scheme}://{rest.split('@', 1)[1]}"
+    return text
+
+
+class RecognitionPipeline:
+    """
+    Threaded camera pipeline:
+
+        capture --(latest frame)--> encoder --(latest JPEG)--> clients
+           \\--(bounded queue)--> recognition --(latest results)--/
+
+    The stream runs at camera rate while recognition runs as fast as the
+    CPU allows; overlays are drawn from the most recent results.
+    """
+    def __init__(self, source, recognize, draw, frame_skip_rate: int = 2,
+                 recognition_queue_size: int = 2, jpeg_quality: int = 80,
+                 realtime: bool = False, loop: bool = False,
+                 history_size: int = 30, on_result=None, tracker=None, detector=None,
+                 name: str = None):
+        # cv2 is imported where it's used so importing this module stays cheap
+        import cv2
+
+        self.source = source
+        # Used for metric labels, stats and logs instead of the source,
+        # which may be a stream URL carrying credentials
+        self.name = name if name is not None else _redact_source(source)
+        # Video files can be paced to their native FPS and looped so they
+        # behave like a live camera (e.g. to stand in for an RTSP stream).
+        self.realtime = realtime
+        self.loop = loop
+        self.recognize = recognize
+        self.draw = draw
+        # Called as on_result(pipeline, result) after every recognized frame.
+        self.on_result = on_result
+        # Optional FaceTracker and FaceDetector, handed to recognize(frame, tracker, detector)
+        self.tracker = tracker
+        self.detector = detector
+        self.frame_skip_rate = max(1, frame_skip_rate)
+        self.jpeg_params = [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality]
+
+        self.frames = LatestSlot()
+        self.history = RecognitionHistory(history_size)
+        self.jpegs = LatestSlot()
+        self.recognition_queue = queue.Queue(maxsize=recognition_queue_size)
+        self.recognition_drops = 0
+        self.counters = {'captured': 0, 'recognized': 0, 'encoded': 0}
+
+        # Replaced on every start(): threads of an earlier run that failed to
+        # stop in time keep their own event and capture, never the new ones.
+        self._stop = threading.Event()
+        self._threads = []
+
+        camera = self.name
+        self._timers = {stage: STAGE_SECONDS.labels(camera=camera, stage=stage)
+                        for stage in ('capture', 'recognize', 'draw', 'jpeg')}
+        self._frames = {stage: FRAMES.labels(camera=camera, stage=stage)
+                        for stage in ('captured', 'recognized', 'encoded')}
+        self._drops = {stage: DROPPED_FRAMES.labels(camera=camera, stage=stage)
+                       for stage in ('recognition', 'encoder', 'stream')}
+        self._faces_per_frame = FACES_PER_FRAME.labels(camera=camera)
+
+    @property
+    def latest_frame(self):
+        """Most recent raw camera frame (BGR), or None before the first read."""
+        return self.frames.peek()
+
+    @property
+    def running(self) -> bool:
+        return any(thread.is_alive() for thread in self._threads)
+
+    def start(self) -> None:
+        """Open the source and start all stages. Raises RuntimeError if it can't be opened."""
+        import cv2
+
+        cap = cv2.VideoCapture(self.source)
+        if not cap.isOpened():
+            raise RuntimeError(f"Could not open video source for camera {self.name!r}")
+        # Keep the driver from queueing stale frames behind the one we want.
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+        # A restarted pipeline must not serve frames from its previous run
+        self.frames = LatestSlot()
+        self.jpegs = LatestSlot()
+        while True:
+            try:
+                self.recognition_queue.get_nowait()
+            except queue.Empty:
+                break
+
+        stop = self._stop = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._capture_loop, args=(cap, stop), name='capture', daemon=True),
+            threading.Thread(target=self._recognition_loop, args=(stop,), name='recognition', daemon=True),
+            threading.Thread(target=self._encoder_loop, args=(stop,), name='encoder', daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        logging.info(f"Pipeline started for camera {self.name!r}")
+
+    def stop(self, wait: bool = True):
+        """
+        Stop all stages. With wait=False the stages are only told to stop
+        and their threads are returned for join(), so a caller holding a
+        lock can wait for them after releasing it.
+        """
+        self._stop.set()
+        threads, self._threads = self._threads, []
+        if wait:
+            self.join(threads)
+        return threads
+
+    def join(self, threads, timeout: float = 2) -> None:
+        """Wait for threads returned by stop(wait=False)."""
+        for thread in threads:
+            thread.join(timeout=timeout)
+        stalled = [thread.name for thread in threads if thread.is_alive()]
+        if stalled:
+            # They exit (and release their capture) whenever the blocking call returns
+            logging.warning(f"Pipeline for camera {self.name!r}: {', '.join(stalled)} still running after stop")
+        logging.info(f"Pipeline stopped for camera {self.name!r}")
+
+    def _capture_loop(self, cap, stop):
+        import cv2
+
+        frames = self.frames
+        frame_counter = 0
+        frame_interval = 1 / (cap.get(cv2.CAP_PROP_FPS) or 30)
+        next_frame_time = time.monotonic()
+        try:
+            while not stop.is_set():
+                start = time.perf_counter()
+                success, frame = cap.read()
+                if not success and self.loop and frame_counter > 0:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    success, frame = cap.read()
+                if stop.is_set():
+                    break  # Stopped while read() blocked; the frame belongs to no one
+                if not success:
+                    logging.warning("Frame capture failed")
+                    break
+                self._timers['capture'].observe(time.perf_counter() - start)
+                if self.realtime:
+                    next_frame_time += frame_interval
+                    time.sleep(max(0.0, next_frame_time - time.monotonic()))
+                frame_counter += 1
+                self.counters['captured'] += 1
+                self._frames['captured'].inc()
+                if frames.put(frame):
+                    self._drops['encoder'].inc()
+
+                # Only every Nth frame goes to recognition
+                if frame_counter % self.frame_skip_rate == 0:
+                    self._enqueue_for_recognition((frame_counter, frame))
+        finally:
+            stop.set()
+            cap.release()
+            logging.info("Camera resource released")
+
+    def _enqueue_for_recognition(self, item):
+        try:
+            self.recognition_queue.put_nowait(item)
+        except queue.Full:
+            # Recognition is behind: replace the oldest pending frame.
+            try:
+                self.recognition_queue.get_nowait()
+                self.recognition_drops += 1
+                self._drops['recognition'].inc()
+            except queue.Empty:
+                pass
+            self.recognition_queue.put_nowait(item)
+
+    def _recognition_loop(self, stop):
+        while not stop.is_set():
+            try:
+                frame_id, frame = self.recognition_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            try:
+                with self._timers['recognize'].time():
+                    faces = self.recognize(frame, self.tracker, self.detector)
+                result = {
+                    'frame_id': frame_id,
+                    'timestamp': time.time(),
+                    'faces': faces
+                }
+                self.history.append(result)
+                self.counters['recognized'] += 1
+                self._frames['recognized'].inc()
+                self._faces_per_frame.observe(len(faces))
+                if self.on_result is not None:
+                    self.on_result(self, result)
+            except Exception as e:
+                logging.error(f"Recognition failed: {str(e)}")
+
+    def _encoder_loop(self, stop):
+        import cv2
+
+        frames, jpegs = self.frames, self.jpegs
+        seq = 0
+        while not stop.is_set():
+            seq, frame = frames.get(seq, timeout=0.1)
+            if frame is None:
+                continue
+            latest = self.history.latest()
+            if latest and latest['faces']:
+                # Draw on a copy so latest_frame stays clean for attendance marking.
+                with self._timers['draw'].time():
+                    frame = frame.copy()
+                    self.draw(frame, latest['faces'])
+            with self._timers['jpeg'].time():
+                ret, buffer = cv2.imencode('.jpg', frame, self.jpeg_params)
+            if ret:
+                if jpegs.put(buffer.tobytes()):
+                    self._drops['stream'].inc()
+                self.counters['encoded'] += 1
+                self._frames['encoded'].inc()
+
+    def jpeg_frames(self, cancel=None):
+        """
+        Yield encoded JPEG frames as they are produced until the pipeline
+        stops or the optional `cancel` event is set (noticed within half a
+        second even if no frame arrives, e.g. while the camera stalls).
+        """
+        stop, jpegs = self._stop, self.jpegs
+        seq = 0
+        while not stop.is_set() and not (cancel is not None and cancel.is_set()):
+            seq, jpeg = jpegs.get(seq, timeout=0.5)
+            if jpeg is not None:
+                yield jpeg
+
+    def stats(self) -> dict:
+        """Per-stage queue depth and drop counts."""
+        stats = {
+            'source': self.name,
+            'running': self.running,
+            'capture': {
+                'frames': self.counters['captured'],
+                'queue_depth': self.frames.depth,
+                'drops': self.frames.drops,
+            },
+            'recognition': {
+                'frames': self.counters['recognized'],
+                'queue_depth': self.recognition_queue.qsize(),
+                'drops': self.recognition_drops,
+            },
+            'encoder': {
+                'frames': self.counters['encoded'],
+                'queue_depth': self.jpegs.depth,
+                'drops': self.jpegs.drops,
+            },
+        }
+        if self.tracker is not None:
+            stats['tracker'] = self.tracker.stats()
+        if self.detector is not None:
+            stats['detector'] = self.detector.stats()
+        return stats
+
+
+class PipelineManager:
+    """
+    One shared pipeline per video source. The pipeline starts when its first
+    client subscribes and stops once the last one disconnects; every client
+    reads the same already-encoded JPEG frames.
+    """
+    def __init__(self, factory):
+        # factory(source) -> RecognitionPipeline
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._pipelines = {}
+        self._subscribers = {}
+
+    def get(self, source):
+        """Return the running pipeline for `source`, or None."""
+        pipeline = self._pipelines.get(source)
+        return pipeline if pipeline is not None and pipeline.running else None
+
+    def subscriber_count(self, source) -> int:
+        return self._subscribers.get(source, 0)
+
+    def _acquire(self, source):
+        with self._lock:
+            pipeline = self._pipelines.get(source)
+            if pipeline is None:
+                pipeline = self._pipelines[source] = self.factory(source)
+            # Also restarts a pipeline whose camera stopped on its own.
+            if not pipeline.running:
+                pipeline.start()
+            self._subscribers[source] = self._subscribers.get(source, 0) + 1
+            return pipeline
+
+    def _release(self, source):
+        with self._lock:
+            self._subscribers[source] -= 1
+            if self._subscribers[source] != 0:
+                return
+            pipeline = self._pipelines[source]
+            # Only signal under the lock; a subscriber arriving meanwhile
+            # starts a fresh run instead of waiting for this one to wind down.
+            threads = pipeline.stop(wait=False)
+        pipeline.join(threads)
+
+    def subscribe(self, source, cancel=None):
+        """
+        Yield JPEG frames from the shared pipeline for one client.
+        A slow client simply skips to the newest frame; it never holds
+        up the producer. Setting `cancel` (a threading.Event) ends the
+        subscription without waiting for another frame. Raises
+        RuntimeError if the source can't be opened.
+        """
+        pipeline = self._acquire(source)
+        try:
+            yield from pipeline.jpeg_frames(cancel)
+        finally:
+            self._release(source)
+
+    def stats(self) -> dict:
+        return {
+            str(source): dict(pipeline.stats(), subscribers=self.subscriber_count(source))
+            for source, pipeline in self._pipelines.items()
+        }
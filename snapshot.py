@@ -0,0 +1,198 @@
+"""
+Gallery snapshot file: the whole FaceGallery in one file that processes
+np.memmap read-only, so every worker shares a single page-cache copy and
+starts without querying SQLite or decoding encodings.
+
+Layout (all sections 64-byte aligned, little-endian):
+    header        magic, format version, gallery version, rows, dim, names size,
+                  source (which database and change log the version belongs to)
+    matrix        float32 (rows, dim)
+    sq_norms      float32 (rows,)
+    user_ids      int64   (rows,)
+    encoding_ids  int64   (rows,)
+    name_offsets  int64   (rows + 1,)  into the names section
+    names         UTF-8 bytes
+"""
+import logging
+import os
+import struct
+import tempfile
+import time
+
+import numpy as np
+
+SNAPSHOT_MAGIC = b'FGALSNAP'
+SNAPSHOT_FORMAT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct('<8sIqqIq64s')
+ALIGNMENT = 64
+# An export lock older than this belongs to a process that died mid-export
+EXPORT_LOCK_TIMEOUT = 300
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _layout(rows: int, dim: int, names_size: int):
+    """Byte offset and size of every section, in file order."""
+    sections = [
+        ('matrix', '<f4', (rows, dim)),
+        ('sq_norms', '<f4', (rows,)),
+        ('user_ids', '<i8', (rows,)),
+        ('encoding_ids', '<i8', (rows,)),
+        ('name_offsets', '<i8', (rows + 1,)),
+        ('names', 'u1', (names_size,)),
+    ]
+    layout = {}
+    offset = _align(SNAPSHOT_HEADER.size)
+    for name, dtype, shape in sections:
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        layout[name] = (offset, dtype, shape)
+        offset = _align(offset + nbytes)
+    return layout, offset
+
+
+def read_snapshot_version(path: str):
+    """
+    (gallery version, source) stored in a snapshot, or None if it is
+    missing or unreadable.
+    """
+    try:
+        with open(path, 'rb') as f:
+            magic, format_version, version, _, _, _, source = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+    except (OSError, struct.error):
+        return None
+    if magic != SNAPSHOT_MAGIC or format_version != SNAPSHOT_FORMAT_VERSION:
+        return None
+    return version, source.rstrip(b'\0').decode('ascii', 'replace')
+
+
+def export_snapshot(gallery, path: str, version: int, source: str = '') -> None:
+    """
+    Write the gallery to `path` atomically: the data goes to a temporary
+    file in the same directory which then replaces the old snapshot, so
+    readers never see a half-written file. `source` identifies where
+    `version` comes from (see GalleryCache.source_id); at most 64 ASCII
+    characters.
+    """
+    rows, dim = len(gallery), gallery.dim
+    encoded_names = [name.encode('utf-8') for name in gallery.names]
+    name_offsets = np.zeros(rows + 1, dtype='<i8')
+    np.cumsum([len(name) for name in encoded_names], out=name_offsets[1:])
+    names = b''.join(encoded_names)
+    layout, total_size = _layout(rows, dim, len(names))
+
+    arrays = {
+        'matrix': gallery.matrix,
+        'sq_norms': gallery.sq_norms,
+        'user_ids': gallery.user_ids,
+        'encoding_ids': gallery.encoding_ids,
+        'name_offsets': name_offsets,
+        'names': np.frombuffer(names, dtype=np.uint8),
+    }
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.gallery-', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.truncate(total_size)
+            f.write(SNAPSHOT_HEADER.pack(
+                SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION, version, rows, dim, len(names), source.encode('ascii')))
+            for name, (offset, dtype, _) in layout.items():
+                f.seek(offset)
+                f.write(np.ascontiguousarray(arrays[name], dtype=dtype).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    logging.info(f"Exported gallery snapshot with {rows} encodings (version {version}) to {path}")
+
+
+def claim_export(path: str) -> bool:
+    """
+    Take the lock (a `.lock` file next to `path`) that lets one of the
+    processes sharing a snapshot rewrite it. Returns False if another
+    process holds it. Release with release_export().
+    """
+    lock_path = f"{path}.lock"
+    for _ in range(2):
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            pass
+        try:
+            if time.time() - os.path.getmtime(lock_path) < EXPORT_LOCK_TIMEOUT:
+                return False
+            logging.warning(f"Removing stale snapshot export lock {lock_path}")
+            os.remove(lock_path)
+        except FileNotFoundError:
+            continue  # Released meanwhile: try again
+        except OSError:
+            return False
+    return False
+
+
+def release_export(path: str) -> None:
+    try:
+        os.remove(f"{path}.lock")
+    except FileNotFoundError:
+        pass
+
+
+def load_snapshot(path: str, source: str = None):
+    """
+    Memory-map a snapshot read-only. Returns (version, matrix, sq_norms,
+    user_ids, encoding_ids, names); the arrays are views of the shared
+    mapping. Raises ValueError if `source` is given and the snapshot was
+    written from a different one. See FaceGallery.from_snapshot().
+    """
+    raw = np.memmap(path, dtype=np.uint8, mode='r')
+    magic, format_version, version, rows, dim, names_size, stored_source = SNAPSHOT_HEADER.unpack(
+        bytes(raw[:SNAPSHOT_HEADER.size]))
+    if magic != SNAPSHOT_MAGIC or format_version != SNAPSHOT_FORMAT_VERSION:
+        raise ValueError(f"{path} is not a gallery snapshot")
+    stored_source = stored_source.rstrip(b'\0').decode('ascii', 'replace')
+    if source is not None and stored_source != source:
+        raise ValueError(f"Snapshot {path} was written for {stored_source!r}, not {source!r}")
+    layout, total_size = _layout(rows, dim, names_size)
+    if raw.size < total_size:
+        raise ValueError(f"Snapshot {path} is truncated")
+
+    arrays = {}
+    for name, (offset, dtype, shape) in layout.items():
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        arrays[name] = raw[offset:offset + nbytes].view(dtype).reshape(shape)
+
+    names_blob = arrays['names'].tobytes()
+    offsets = arrays['name_offsets'].tolist()
+    names = [names_blob[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(rows)]
+    return (version, arrays['matrix'], arrays['sq_norms'],
+            arrays['user_ids'], arrays['encoding_ids'], names)
+
+
+if __name__ == '__main__':
+    import argparse
+    from database import FaceDatabase
+    from gallery import FaceGallery, gallery_source
+
+    parser = argparse.ArgumentParser(description="Export the face gallery to a memory-mappable snapshot")
+    parser.add_argument('--db', default='face_recognition.db')
+    parser.add_argument('--out', default=None,
+                        help="Defaults to gallery.snapshot, or gallery.snapshot.templates with --templates")
+    parser.add_argument('--templates', action=argparse.BooleanOptionalAction, default=True,
+                        help="One template per user, as served with GALLERY_TEMPLATES (the default)")
+    args = parser.parse_args()
+    out = args.out or ('gallery.snapshot.templates' if args.templates else 'gallery.snapshot')
+
+    db = FaceDatabase(args.db)
+    version = db.get_template_version() if args.templates else db.get_gallery_version()
+    gallery = FaceGallery.from_database(db, templates=args.templates)
+    source = gallery_source(db, args.templates)
+    db.close()
+    export_snapshot(gallery, out, version, source)
+    print(f"Saved snapshot of {len(gallery)} {'templates' if args.templates else 'encodings'} "
+          f"(version {version}) to {out}")
@@ -0,0 +1,99 @@
+import time
+
+import pytest
+
+from attendance_writer import AttendanceWriter
+from database import ConnectionPool, FaceDatabase
+
+
+def _record(db, user_id, day, timestamp):
+    db.conn.execute(
+        'INSERT INTO attendance_records (user_id, day, timestamp) VALUES (?, ?, ?)',
+        (user_id, day, timestamp))
+    db.conn.commit()
+
+
+@pytest.fixture
+def berlin_time(monkeypatch):
+    if not hasattr(time, 'tzset'):
+        pytest.skip("needs time.tzset")
+    monkeypatch.setenv('TZ', 'Europe/Berlin')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_attendance_page_filters_on_local_day(tmp_path, berlin_time):
+    db = FaceDatabase(str(tmp_path / 'a.db'))
+    alice = db.add_user('alice')
+    bob = db.add_user('bob')
+    # Just after local midnight east of UTC: the UTC timestamp is still the day before
+    _record(db, alice, '2026-03-02', '2026-03-01 23:30:00')
+    _record(db, bob, '2026-03-01', '2026-03-01 08:00:00')
+
+    assert [row[1:] for row in db.get_attendance_page('2026-03-02', '2026-03-03')] == [('alice', '2026-03-02 00:30')]
+    assert [row[1] for row in db.get_attendance_page('2026-03-01', '2026-03-02')] == ['bob']
+    db.close()
+
+
+def test_attendance_pages_follow_day_order(tmp_path):
+    db = FaceDatabase(str(tmp_path / 'a.db'))
+    users = [db.add_user(f"user{i}") for i in range(5)]
+    for i, user_id in enumerate(users):
+        _record(db, user_id, f"2026-03-0{i + 1}", '2026-03-01 12:00:00')
+
+    names, before = [], None
+    while True:
+        page = db.get_attendance_page(limit=2, before_id=before)
+        if not page:
+            break
+        names += [row[1] for row in page]
+        before = page[-1][0]
+    assert names == ['user4', 'user3', 'user2', 'user1', 'user0']
+    db.close()
+
+
+def test_bad_entry_does_not_fail_the_rest_of_its_batch(tmp_path):
+    path = str(tmp_path / 'a.db')
+    db = FaceDatabase(path)
+    alice = db.add_user('alice')
+    bob = db.add_user('bob')
+    pool = ConnectionPool(path)
+    # A long flush interval so all three land in one batch
+    writer = AttendanceWriter(pool, flush_interval=5.0)
+    futures = [writer.submit(user_id, '2026-03-01') for user_id in (alice, 999, bob)]
+    writer.flush()
+
+    assert futures[0].result() is True
+    assert futures[2].result() is True
+    with pytest.raises(Exception, match='FOREIGN KEY'):
+        futures[1].result()
+    rows = db.conn.execute('SELECT user_id FROM attendance_records ORDER BY user_id').fetchall()
+    assert [row[0] for row in rows] == [alice, bob]
+    writer.close()
+    pool.close()
+    db.close()
+
+
+def test_get_user_ids_by_name(tmp_path):
+    db = FaceDatabase(str(tmp_path / 'a.db'))
+    alice = db.add_user('alice', department='Sales')
+    bob_sales = db.add_user('bob', department='Sales')
+    bob_ops = db.add_user('bob', department='Ops')
+
+    assert db.get_user_ids_by_name(['alice', 'bob', 'carol']) == {'alice': [alice], 'bob': [bob_sales, bob_ops]}
+    assert db.get_user_ids_by_name(['bob'], department='Ops') == {'bob': [bob_ops]}
+    db.close()
+
+
+def test_daily_reports_use_local_times(tmp_path, berlin_time):
+    db = FaceDatabase(str(tmp_path / 'a.db'))
+    alice = db.add_user('alice')
+    _record(db, alice, '2026-03-02', '2026-03-01 23:30:00')
+
+    rows = [row for batch in db.iter_daily_attendance() for row in batch]
+    assert [row[0] for row in rows] == ['2026-03-02']
+    assert rows[0][4:6] == ('2026-03-02 00:30:00', '2026-03-02 00:30:00')
+    assert db.get_user_summary()[0][4:] == ('2026-03-02 00:30:00', '2026-03-02 00:30:00')
+    db.close()
@@ -0,0 +1,138 @@
+import time
+
+import numpy as np
+
+from database import FaceDatabase
+from gallery import FaceGallery, GalleryCache, gallery_source
+from matcher import ExactMatcher, IVFMatcher, build_matcher, matcher_is_stale
+from snapshot import claim_export, export_snapshot, read_snapshot_version, release_export
+
+
+def _enroll(db, names, seed=0):
+    rng = np.random.default_rng(seed)
+    db.add_users_bulk([
+        {'name': name, 'encodings': [rng.normal(size=128).astype(np.float32)]} for name in names
+    ])
+
+
+def _wait_for_snapshot(path, source, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        on_disk = read_snapshot_version(path)
+        if on_disk is not None and on_disk[1] == source:
+            return on_disk
+        time.sleep(0.01)
+    raise AssertionError(f"snapshot for {source} was not written")
+
+
+def test_snapshot_from_another_database_is_ignored(tmp_path):
+    snapshot_path = str(tmp_path / 'gallery.snapshot')
+
+    old_db = FaceDatabase(str(tmp_path / 'a.db'))
+    _enroll(old_db, [f"old{i}" for i in range(5)])
+    GalleryCache(old_db, snapshot_path=snapshot_path).refresh()
+    _wait_for_snapshot(snapshot_path, gallery_source(old_db))
+    old_db.close()
+
+    # A fresh database: user_ids start at 1 again and the version is lower
+    new_db = FaceDatabase(str(tmp_path / 'b.db'))
+    _enroll(new_db, ['new0'], seed=1)
+    gallery = GalleryCache(new_db, snapshot_path=snapshot_path).refresh()
+
+    assert gallery.names == ['new0']
+    assert gallery.user_ids.tolist() == [1]
+    version, _ = _wait_for_snapshot(snapshot_path, gallery_source(new_db))
+    assert version == new_db.get_gallery_version()
+    new_db.close()
+
+
+def test_snapshot_ahead_of_database_is_ignored(tmp_path):
+    snapshot_path = str(tmp_path / 'gallery.snapshot')
+    db = FaceDatabase(str(tmp_path / 'a.db'))
+    _enroll(db, ['alice', 'bob'])
+    GalleryCache(db, snapshot_path=snapshot_path).refresh()
+    _wait_for_snapshot(snapshot_path, gallery_source(db))
+
+    # Same database id, but its change log was rolled back (e.g. restored from a backup)
+    db.conn.execute('DELETE FROM users WHERE name = ?', ('bob',))
+    db.conn.execute('DELETE FROM gallery_changes')
+    db.conn.commit()
+    gallery = GalleryCache(db, snapshot_path=snapshot_path).refresh()
+
+    assert gallery.names == ['alice']
+    db.close()
+
+
+def _matcher_cache(db, min_ann_size):
+    return GalleryCache(
+        db,
+        matcher_factory=lambda gallery: build_matcher(gallery, min_ann_size=min_ann_size),
+        matcher_is_stale=lambda matcher: matcher_is_stale(matcher, min_ann_size=min_ann_size)
+    )
+
+
+def test_matcher_rebuilt_when_gallery_crosses_ann_threshold(tmp_path):
+    db = FaceDatabase(str(tmp_path / 'a.db'))
+    _enroll(db, ['alice'])
+    cache = _matcher_cache(db, min_ann_size=3)
+    assert isinstance(cache.refresh(), ExactMatcher)
+
+    _enroll(db, [f"user{i}" for i in range(5)], seed=1)
+    assert isinstance(cache.refresh(), IVFMatcher)
+
+    db.conn.execute("DELETE FROM users WHERE name LIKE 'user%'")
+    db.conn.commit()
+    assert isinstance(cache.refresh(), ExactMatcher)
+    db.close()
+
+
+def test_ivf_matcher_retrained_when_gallery_doubles(tmp_path):
+    db = FaceDatabase(str(tmp_path / 'a.db'))
+    _enroll(db, [f"user{i}" for i in range(4)])
+    cache = _matcher_cache(db, min_ann_size=3)
+    matcher = cache.refresh()
+    assert matcher.trained_size == 4
+
+    _enroll(db, ['extra0'], seed=1)
+    assert cache.refresh() is matcher
+
+    _enroll(db, [f"more{i}" for i in range(4)], seed=2)
+    matcher = cache.refresh()
+    assert isinstance(matcher, IVFMatcher)
+    assert matcher.trained_size == 9
+    db.close()
+
+
+def test_changes_to_a_mapped_snapshot_leave_it_shared(tmp_path):
+    rng = np.random.default_rng(0)
+    private = FaceGallery(capacity=4)
+    private.extend(rng.normal(size=(50, 128)), list(range(50)), [f"u{i}" for i in range(50)], list(range(50)))
+    path = str(tmp_path / 'gallery.snapshot')
+    export_snapshot(private, path, version=1)
+    mapped, _ = FaceGallery.from_snapshot(path)
+
+    for step in range(20):
+        removed = rng.choice(private.encoding_ids, 3, replace=False).tolist()
+        assert np.array_equal(private.remove(removed), mapped.remove(removed))
+        ids = list(range(1000 + step * 5, 1005 + step * 5))
+        added = rng.normal(size=(5, 128))
+        private.extend(added, ids, [f"n{i}" for i in ids], ids)
+        mapped.extend(added, ids, [f"n{i}" for i in ids], ids)
+
+    assert mapped.shares_snapshot and isinstance(mapped._base, np.memmap)
+    assert mapped._tail_size < 2 * 100
+    assert np.array_equal(mapped.encoding_ids, private.encoding_ids)
+    assert np.array_equal(mapped.matrix, private.matrix)
+    queries = rng.normal(size=(3, 128))
+    assert np.allclose(mapped.distances(queries), private.distances(queries), atol=1e-4)
+    rows = np.array([0, 7, len(private) - 1])
+    assert np.allclose(mapped.distances(queries, rows), private.distances(queries, rows), atol=1e-4)
+
+
+def test_only_one_process_exports_at_a_time(tmp_path):
+    path = str(tmp_path / 'gallery.snapshot')
+    assert claim_export(path)
+    assert not claim_export(path)
+    release_export(path)
+    assert claim_export(path)
+    release_export(path)
@@ -0,0 +1,112 @@
+import itertools
+
+import numpy as np
+
+
+def box_iou(boxes_a, boxes_b):
+    """
+    Intersection-over-union between two lists of (top, right, bottom, left)
+    boxes. Returns a (len(boxes_a), len(boxes_b)) array.
+    """
+    a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    top = np.maximum(a[:, None, 0], b[None, :, 0])
+    right = np.minimum(a[:, None, 1], b[None, :, 1])
+    bottom = np.minimum(a[:, None, 2], b[None, :, 2])
+    left = np.maximum(a[:, None, 3], b[None, :, 3])
+    intersection = np.clip(right - left, 0, None) * np.clip(bottom - top, 0, None)
+    area_a = (a[:, 1] - a[:, 3]) * (a[:, 2] - a[:, 0])
+    area_b = (b[:, 1] - b[:, 3]) * (b[:, 2] - b[:, 0])
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-6), 0)
+
+
+class Track:
+    """A face followed across frames, with the identity from its last encoding."""
+    def __init__(self, track_id: int, box):
+        self.track_id = track_id
+        self.box = box
+        self.encoding = None
+        self.user_id = None
+        self.name = None
+        self.distance = float('inf')
+        self.confidence = float('-inf')
+        self.missed = 0
+        # Frames since the encoder last ran on this face
+        self.age_since_encoding = 0
+
+    def identify(self, encoding, user_id, name, distance: float, confidence: float) -> None:
+        self.encoding = encoding
+        self.user_id = user_id
+        self.name = name
+        self.distance = distance
+        self.confidence = confidence
+        self.age_since_encoding = 0
+
+
+class FaceTracker:
+    """
+    Associates detected face boxes across frames by IoU so the 128-d
+    encoder only runs for new faces, plus a periodic re-verification.
+    """
+    def __init__(self, iou_threshold: float = 0.3, max_missed: int = 5,
+                 reverify_interval: int = 15, unknown_retry_interval: int = 3):
+        self.iou_threshold = iou_threshold
+        # Drop a track after this many processed frames without a detection
+        self.max_missed = max_missed
+        # Re-encode identified tracks every N frames...
+        self.reverify_interval = reverify_interval
+        # ...and unidentified ones more often, in case the pose improves
+        self.unknown_retry_interval = unknown_retry_interval
+        self.tracks = []
+        self._ids = itertools.count(1)
+        self.encoded = 0
+        self.reused = 0
+
+    def update(self, boxes):
+        """
+        Match this frame's boxes to existing tracks.
+        Returns (tracks, needs_encoding): the track for every box, in order,
+        and the indices of boxes that must go through the encoder.
+        """
+        assigned = [None] * len(boxes)
+        unmatched_tracks = set(range(len(self.tracks)))
+        if boxes and self.tracks:
+            iou = box_iou([track.box for track in self.tracks], boxes)
+            # Greedy assignment, best overlaps first
+            for t, b in zip(*np.unravel_index(np.argsort(-iou, axis=None), iou.shape)):
+                if iou[t, b] < self.iou_threshold:
+                    break
+                if t in unmatched_tracks and assigned[b] is None:
+                    assigned[b] = self.tracks[t]
+                    unmatched_tracks.discard(t)
+
+        for t in unmatched_tracks:
+            self.tracks[t].missed += 1
+        self.tracks = [track for track in self.tracks if track.missed <= self.max_missed]
+
+        needs_encoding = []
+        for i, box in enumerate(boxes):
+            track = assigned[i]
+            if track is None:
+                track = assigned[i] = Track(next(self._ids), box)
+                self.tracks.append(track)
+                needs_encoding.append(i)
+                continue
+            track.box = box
+            track.missed = 0
+            track.age_since_encoding += 1
+            interval = self.reverify_interval if track.user_id is not None else self.unknown_retry_interval
+            if track.encoding is None or track.age_since_encoding >= interval:
+                needs_encoding.append(i)
+
+        self.encoded += len(needs_encoding)
+        self.reused += len(boxes) - len(needs_encoding)
+        return assigned, needs_encoding
+
+    def stats(self) -> dict:
+        return {
+            'tracks': len(self.tracks),
+            'encoded': self.encoded,
+            'reused': self.reused,
+        }
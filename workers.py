@@ -0,0 +1,193 @@
+import atexit
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Shared memory blocks this worker process has already attached to.
+_attached = {}
+
+
+def _attach(name: str):
+    shm = _attached.get(name)
+    if shm is None:
+        # Pool workers share the parent's resource tracker, which unlinks
+        # the block once the parent does; attaching here adds no owner.
+        shm = _attached[name] = shared_memory.SharedMemory(name=name)
+    return shm
+
+
+def _small_rgb(frame, scale: float):
+    import cv2
+
+    small_frame = cv2.resize(frame, (0, 0), fx=scale, fy=scale)
+    return cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
+
+
+def locate_faces(frame, scale: float = 0.25, model: str = 'hog', upsample: int = 1, regions=None):
+    """
+    Detect faces in a BGR frame, optionally only inside `regions`
+    (full-frame (top, right, bottom, left) boxes; None scans everything).
+    Returns (top, right, bottom, left) boxes in full-frame coordinates.
+    """
+    import face_recognition
+
+    if regions is None:
+        height, width = frame.shape[:2]
+        regions = [(0, width, height, 0)]
+    factor = 1 / scale
+    boxes = []
+    for top, right, bottom, left in regions:
+        crop = frame[top:bottom, left:right]
+        if crop.size == 0:
+            continue
+        face_locations = face_recognition.face_locations(
+            _small_rgb(crop, scale), number_of_times_to_upsample=upsample, model=model)
+        boxes.extend(
+            (int(round(t * factor)) + top, int(round(r * factor)) + left,
+             int(round(b * factor)) + top, int(round(l * factor)) + left)
+            for t, r, b, l in face_locations
+        )
+    return boxes
+
+
+def encode_faces(frame, locations, scale: float = 0.25):
+    """
+    Compute 128-d encodings for the given full-frame boxes of a BGR frame.
+    """
+    import face_recognition
+
+    if not locations:
+        return []
+    small_locations = [tuple(int(round(value * scale)) for value in location) for location in locations]
+    face_encodings = face_recognition.face_encodings(_small_rgb(frame, scale), small_locations)
+    return [np.asarray(encoding, dtype=np.float32) for encoding in face_encodings]
+
+
+def _shared_frame(shm_name: str, shape, dtype: str):
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=_attach(shm_name).buf)
+
+
+def _locate_faces_shared(shm_name: str, shape, dtype: str, scale: float, detect_options):
+    """Worker entry point: read the frame straight out of shared memory."""
+    return locate_faces(_shared_frame(shm_name, shape, dtype), scale, **detect_options)
+
+
+def _warm_up():
+    """Worker entry point: load the face models before the first real frame."""
+    locate_faces(np.zeros((120, 160, 3), dtype=np.uint8))
+    return os.getpid()
+
+
+def _encode_faces_shared(shm_name: str, shape, dtype: str, locations, scale: float):
+    return encode_faces(_shared_frame(shm_name, shape, dtype), locations, scale)
+
+
+class LocalFrame:
+    """
+    Runs detection and encoding for one frame in the calling process.
+    Same interface as the pool's SharedFrame.
+    """
+    def __init__(self, frame):
+        self.frame = frame
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def locate(self, scale: float = 0.25, **detect_options):
+        return locate_faces(self.frame, scale, **detect_options)
+
+    def encode(self, locations, scale: float = 0.25):
+        return encode_faces(self.frame, locations, scale)
+
+
+class SharedFrame:
+    """
+    A frame copied into a pooled shared memory block; detection and encoding
+    run in worker processes that read it in place. Use as a context manager
+    so the block goes back to the pool.
+    """
+    def __init__(self, pool, frame):
+        self.pool = pool
+        frame = np.ascontiguousarray(frame)
+        self.shape = frame.shape
+        self.dtype = frame.dtype.str
+        self._shm = pool._borrow(frame.nbytes)
+        np.ndarray(frame.shape, dtype=frame.dtype, buffer=self._shm.buf)[:] = frame
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.pool._give_back(self._shm)
+        return False
+
+    def locate(self, scale: float = 0.25, **detect_options):
+        return self.pool._executor.submit(
+            _locate_faces_shared, self._shm.name, self.shape, self.dtype, scale, detect_options).result()
+
+    def encode(self, locations, scale: float = 0.25):
+        if not locations:
+            return []
+        return self.pool._executor.submit(
+            _encode_faces_shared, self._shm.name, self.shape, self.dtype, locations, scale).result()
+
+
+class RecognitionWorkerPool:
+    """
+    Process pool for face detection and encoding. Frames are copied into
+    reusable shared memory blocks and only the block name is sent to the
+    worker, so no frame is ever pickled.
+    """
+    def __init__(self, processes: int = None):
+        self.processes = processes or os.cpu_count() or 1
+        self._executor = ProcessPoolExecutor(max_workers=self.processes)
+        self._lock = threading.Lock()
+        self._free = []
+        self._blocks = []
+        atexit.register(self.shutdown)
+        logging.info(f"Recognition worker pool with {self.processes} processes")
+
+    def _borrow(self, size: int):
+        with self._lock:
+            for i, shm in enumerate(self._free):
+                if shm.size >= size:
+                    return self._free.pop(i)
+            shm = shared_memory.SharedMemory(create=True, size=size)
+            self._blocks.append(shm)
+            return shm
+
+    def _give_back(self, shm):
+        with self._lock:
+            self._free.append(shm)
+
+    def frame(self, frame) -> SharedFrame:
+        """Share a frame with the workers: `with pool.frame(f) as shared: shared.locate()`."""
+        return SharedFrame(self, frame)
+
+    def warm_up(self) -> None:
+        """
+        Start the worker processes and have each load the face models.
+        Loading takes long enough that the tasks spread over all workers.
+        """
+        futures = [self._executor.submit(_warm_up) for _ in range(self.processes)]
+        pids = {future.result() for future in futures}
+        logging.info(f"Recognition workers warmed up ({len(pids)} of {self.processes} processes)")
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        with self._lock:
+            for shm in self._blocks:
+                shm.close()
+                try:
+                    shm.unlink()
+                except FileNotFoundError:
+                    pass
+            self._blocks = []
+            self._free = []